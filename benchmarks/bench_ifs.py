@@ -0,0 +1,117 @@
+"""Stress test replace_ifs on deeply nested if statements.
+
+Usage: python benchmarks/bench_ifs.py [max depth]
+
+Besides valid ifs, malformed ones are timed: unclosed conditions and unclosed
+branches, which a parser retrying failed ifs takes exponential time on.
+
+The recursive regex rewriter it replaced is timed too when the regex module is
+installed, until a single rewrite takes longer than 0.1s.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from dscript import cond_replacer
+from dscript import replace_ifs_uncached as replace_ifs
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+
+def replace_ifs_regex(l):
+    """The rewriter from before replace_ifs, for comparison"""
+    did_match = True
+    sub = lambda s: regex.sub(
+        r"\|if(?: ?)\((.+?)\)(?: ?)then(?: ?)(?:((?R))|(.+?))(?:(?: else )(?:((?R))|(.+)))?\|",
+        replace,
+        s,
+    )
+
+    while did_match:
+        did_match = False
+
+        def replace(m):
+            nonlocal did_match
+            did_match = True
+            cond, truerecurse, trueres, falserecurse, falseres = m.groups()
+            if truerecurse:
+                trueres = sub(truerecurse)
+            if falserecurse:
+                falseres = sub(falserecurse)
+            return cond_replacer(cond, trueres, falseres)
+
+        l = sub(l)
+    return l
+
+
+# 'and' and 'or' copy a branch, so they are only used in the innermost if to
+#  keep the size of the output linear in the depth.
+
+
+def else_chain(depth):
+    """|if (x = 1) then f(1) else |if (x = 2) then f(2) else ... 0|...|"""
+    l = "|if (x = 0 and y > 0) then 1 else 0|"
+    for i in range(depth - 1, 0, -1):
+        l = f"|if (x = {i}) then f({i}) else {l}|"
+    return "y = " + l
+
+
+def then_chain(depth):
+    """|if (x = 1) then |if (x = 2) then ... else [2, 0]| else [1, 0]|"""
+    l = "|if (x = 0 or y < 0) then f(x) else 0|"
+    for i in range(depth - 1, 0, -1):
+        l = f"|if (x = {i}) then {l} else [{i}, 0]|"
+    return "y = " + l
+
+
+def unclosed_conds(depth):
+    """|if ((|if ((... with nothing closed"""
+    return "y = " + "|if ((" * depth
+
+
+def unclosed_branches(depth):
+    """|if (a) then |if (a) then ... with no closing |"""
+    return "y = " + "|if (a) then " * depth
+
+
+def timed(fn, l, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(l)
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main():
+    max_depth = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    depths = [d for d in (1, 2, 3, 5, 10, 20, 30, 40, 50, 200, 2000) if d <= max_depth]
+    for name, make in [
+        ("else chain", else_chain),
+        ("then chain", then_chain),
+        ("unclosed conditions", unclosed_conds),
+        ("unclosed branches", unclosed_branches),
+    ]:
+        print(name)
+        print(f"  {'depth':>5} {'chars':>7} {'replace_ifs':>13} {'regex':>13}")
+        regex_ok = regex is not None
+        for depth in depths:
+            l = make(depth)
+            new = timed(replace_ifs, l)
+            old = "-"
+            if regex_ok:
+                t = timed(replace_ifs_regex, l, repeat=1)
+                old = f"{t * 1000:10.3f} ms"
+                regex_ok = t < 0.1
+            print(f"  {depth:>5} {len(l):>7} {new * 1000:10.3f} ms {old:>13}")
+
+
+if __name__ == "__main__":
+    main()
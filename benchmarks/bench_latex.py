@@ -0,0 +1,72 @@
+"""Compare convert_to_latex against the old multi-pass convert_to_latex_legacy.
+
+Usage: python benchmarks/bench_latex.py [repeat]
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from dscript import convert_to_latex_legacy
+from dscript import convert_to_latex_uncached as convert_to_latex
+
+SOURCES = ["pong.dscript", "dscript/cpu.dscript", "dscript/example.dscript"]
+
+SYNTHETIC = [
+    "pos{n} = (xpos{n} + vel{n}*dt, ypos{n} - frac(grav{n}, 2))",
+    "d{n}(a, b) = sqrt((a.x - b.x)^2 + (a.y - b.y)^2) + sin(theta{n})*cos(phi{n})",
+    "l{n} = [{{i <= 3: 1, 0}}, floor(length(arr{n})/2), max(abc, def{n})]",
+    "polygon(r(0, -0.5, 15 + n{n}, 10), (x{n} >= 0))",
+    "a{n} = {{c = 1: {{b{n} = 1: 1, 0}}, 0}}",
+]
+
+
+def load_repo_samples():
+    samples = []
+    for name in SOURCES:
+        with open(os.path.join(ROOT, name), "r") as f:
+            for l in f:
+                l = l.split("#")[0].strip().rstrip("\\")
+                if l and not l.startswith('"'):
+                    samples.append(l)
+    return samples * 20
+
+
+def load_synthetic_samples(n=2000):
+    return [s.format(n=i) for i in range(n) for s in SYNTHETIC]
+
+
+def bench(fn, samples, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for s in samples:
+            fn(s)
+        t = time.process_time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    for corpus, samples in [
+        ("repo scripts", load_repo_samples()),
+        ("synthetic", load_synthetic_samples()),
+    ]:
+        for s in samples:
+            if convert_to_latex(s) != convert_to_latex_legacy(s):
+                raise AssertionError(f"Output differs for {s!r}")
+
+        print(f"{corpus} ({len(samples)} expressions)")
+        times = {}
+        for fn in (convert_to_latex_legacy, convert_to_latex):
+            t = times[fn] = bench(fn, samples, repeat)
+            print(f"  {fn.__name__:<26} {t * 1000:8.2f} ms  {len(samples) / t:10,.0f} exp/s")
+        speedup = times[convert_to_latex_legacy] / times[convert_to_latex]
+        print(f"  speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
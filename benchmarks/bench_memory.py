@@ -0,0 +1,67 @@
+"""Compare the memory used by ExpressionRecord against plain expression dicts.
+
+Usage: python benchmarks/bench_memory.py [expressions]
+"""
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from dscript import ExpressionRecord
+
+
+def make_dicts(n):
+    explist = []
+    for i in range(n):
+        exp = {
+            "type": "expression",
+            "color": "#" + "00ff00",
+            "latex": f"x_{{{i}}}=1",
+            "folderId": str(2),
+            "id": str(i + 3),
+        }
+        if i % 4 == 0:
+            exp["slider"] = {"hardMin": True, "hardMax": True, "min": "0", "max": "1"}
+        if i % 8 == 0:
+            exp["hidden"] = True
+        explist.append(exp)
+    return explist
+
+
+def make_records(n):
+    explist = []
+    for i in range(n):
+        exp = ExpressionRecord(
+            "expression", color="#" + "00ff00", latex=f"x_{{{i}}}=1", folderId=str(2)
+        )
+        exp.id = str(i + 3)
+        if i % 4 == 0:
+            exp["slider"] = {"hardMin": True, "hardMax": True, "min": "0", "max": "1"}
+        if i % 8 == 0:
+            exp["hidden"] = True
+        explist.append(exp)
+    return explist
+
+
+def measure(fn, n):
+    tracemalloc.start()
+    explist = fn(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del explist
+    return size
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dicts = measure(make_dicts, n)
+    records = measure(make_records, n)
+    for name, size in [("dict", dicts), ("ExpressionRecord", records)]:
+        print(f"{name:<17} {size / 2 ** 20:8.2f} MiB  {size / n:6.0f} bytes/exp")
+    print(f"saved: {(1 - records / dicts) * 100:.0f}% over {n} expressions")
+
+
+if __name__ == "__main__":
+    main()
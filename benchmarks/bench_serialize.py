@@ -0,0 +1,71 @@
+"""Compare serializing a compiled graph with DesmosScript.dumps against json.dumps.
+
+The old path dumped the json dict for the output file, then again compactly for
+the upload; dumps is done once and used for both.
+
+Usage: python benchmarks/bench_serialize.py [expressions] [repeats]
+"""
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from dscript import DesmosScript
+from dscript.serialize import dumps
+
+
+def make_graph(n):
+    lines = ["xbounds -20,20"]
+    for i in range(n):
+        if i % 100 == 0:
+            lines.append(f"folder group {i}")
+        lines.append(f"a_{{{i}}} = sin(x) * {i} + |if (x > {i}) then 1 else 0|")
+        if i % 4 == 0:
+            lines.append("slider 0 to 1 @2x")
+        if i % 8 == 0:
+            lines.append("hidden")
+        if i % 100 == 99:
+            lines.append("end")
+    g = DesmosScript(randseed="0")
+    g.parse("\n".join(lines))
+    return g
+
+
+def old(g):
+    out = json.dumps(g.json())
+    upload = json.dumps(g.json(), separators=(",", ":"), sort_keys=True)
+    return out, upload
+
+
+def new(g):
+    out = g.dumps()
+    return out, out
+
+
+def best(fn, g, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.process_time()
+        fn(g)
+        times.append(time.process_time() - start)
+    return min(times)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    g = make_graph(n)
+    assert new(g)[0] == dumps(g.json())
+
+    t_old = best(old, g, repeats)
+    t_new = best(new, g, repeats)
+    print(f"json.dumps twice {t_old * 1000:8.1f} ms")
+    print(f"dumps once       {t_new * 1000:8.1f} ms")
+    print(f"speedup: {t_old / t_new:.2f}x over {len(g.explist)} expressions")
+
+
+if __name__ == "__main__":
+    main()
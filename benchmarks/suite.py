@@ -0,0 +1,233 @@
+"""Time the compiler's stages on generated DesmosScript corpora.
+
+Usage: python benchmarks/suite.py [--scale N] [--repeats N] [--only NAME...]
+                                  [--output FILE] [--baseline FILE]
+
+Each corpus is timed through DesmosScript.parse, convert_to_latex (on its
+expression lines), json(), dumps() and compile_file, taking the best of the
+repeats in cpu time. Peak memory is measured on a separate parse, since
+tracemalloc slows everything down. Results are written as json; with
+--baseline, each time is also printed as a ratio to the same one in an earlier
+run's results.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from dscript import (
+    DesmosScript,
+    Include,
+    clear_caches,
+    compile_file,
+    convert_to_latex,
+    replace_ifs,
+)
+
+
+def expressions(scale):
+    """Plain expressions, the common case"""
+    return {
+        "main.dscript": "\n".join(
+            f"f_{{{i}}}(x) = sin(x * {i}) / (1 + x^2) + sqrt(abs(x - {i}))"
+            for i in range(scale)
+        )
+    }
+
+
+def nested_ifs(scale, depth=12):
+    lines = []
+    for i in range(scale // depth):
+        l = "|if (x = 0 and y > 0) then 1 else 0|"
+        for d in range(depth - 1, 0, -1):
+            l = f"|if (x = {d}) then g({d}) else {l}|"
+        lines.append(f"c_{{{i}}} = {l}")
+    return {"main.dscript": "\n".join(lines)}
+
+
+def annotations(scale):
+    """Expressions each followed by slider, label and other modifiers"""
+    lines = []
+    for i in range(scale // 5):
+        lines += [
+            f"a_{{{i}}} = {i % 10}",
+            "slider 0 to 10 @2x step 0.1 fwd",
+            f"label value {i}",
+            "labelopts above",
+            "draggable XY" if i % 2 else "hidden",
+        ]
+    return {"main.dscript": "\n".join(lines)}
+
+
+def folders(scale, size=4):
+    lines = []
+    for i in range(scale // (size + 2)):
+        lines.append(f"folder{'-closed' if i % 2 else ''} group {i}")
+        lines.append(f"color #{i * 2654435761 % 0xFFFFFF:06x}")
+        lines += [f"h_{{{i}}}(x) = x^{j} + {i}" for j in range(size)]
+        lines.append("endfolder")
+    return {"main.dscript": "\n".join(lines)}
+
+
+def includes(scale, fanout=20):
+    """A main file including many packages, some of which include each other"""
+    size = max(scale // fanout, 1)
+    files = {}
+    for p in range(fanout):
+        lines = [f"p_{{{p}{j}}}(x) = x * {j} + {p}" for j in range(size)]
+        if p % 2:
+            lines.insert(0, f"include pkg{p - 1}")
+        files[f"pkg{p}.dscript"] = "\n".join(lines)
+    files["main.dscript"] = "\n".join(f"include pkg{p}" for p in range(fanout))
+    return files
+
+
+def continuations(scale, width=40):
+    """Long expressions split over lines with \\"""
+    lines = []
+    for i in range(scale // width):
+        lines.append(f"l_{{{i}}}(x) = 0 \\")
+        lines += [f"    + x^{j} * {j} \\" for j in range(width - 2)]
+        lines.append("    + 1")
+    return {"main.dscript": "\n".join(lines)}
+
+
+CORPORA = {
+    f.__name__: f
+    for f in [expressions, nested_ifs, annotations, folders, includes, continuations]
+}
+
+
+def best(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.process_time()
+        fn()
+        times.append(time.process_time() - start)
+    return min(times)
+
+
+def parse(source):
+    # each run compiles from scratch, with no includes or conversions cached
+    Include.PACKAGE_CACHE.clear()
+    clear_caches()
+    g = DesmosScript(randseed="0")
+    g.parse(source)
+    return g
+
+
+def expression_lines(files):
+    lines = []
+    for source in files.values():
+        for l in source.replace("\\\n", "").split("\n"):
+            l = l.strip()
+            if "=" in l and l.split(" ")[0] not in ("slider", "label", "labelopts"):
+                lines.append(replace_ifs(l))
+    return lines
+
+
+def run_corpus(name, scale, repeats):
+    files = CORPORA[name](scale)
+    source = files["main.dscript"]
+    nlines = sum(s.count("\n") + 1 for s in files.values())
+    latex_lines = expression_lines(files)
+
+    result = {"lines": nlines}
+    with tempfile.TemporaryDirectory() as d:
+        for fname, text in files.items():
+            with open(os.path.join(d, fname), "w") as f:
+                f.write(text)
+        # includes are found relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(d)
+        try:
+            g = parse(source)
+            result["expressions"] = len(g.explist)
+            result["parse"] = best(lambda: parse(source), repeats)
+
+            def convert():
+                clear_caches()
+                return [convert_to_latex(l) for l in latex_lines]
+
+            result["convert_to_latex"] = best(convert, repeats)
+            result["json"] = best(g.json, repeats)
+            result["dumps"] = best(g.dumps, repeats)
+
+            def compile_main():
+                Include.PACKAGE_CACHE.clear()
+                clear_caches()
+                compile_file("main.dscript", "main.djson", randseed="0")
+
+            result["compile_file"] = best(compile_main, repeats)
+
+            tracemalloc.start()
+            g = parse(source)
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+
+    result["parse_lines_per_s"] = nlines / result["parse"] if result["parse"] else None
+    result["compile_lines_per_s"] = (
+        nlines / result["compile_file"] if result["compile_file"] else None
+    )
+    return result
+
+
+STAGES = ["parse", "convert_to_latex", "json", "dumps", "compile_file"]
+
+
+def print_results(results, baseline=None):
+    header = f"{'corpus':<14} {'lines':>7}" + "".join(f" {s:>16}" for s in STAGES)
+    print(header + f" {'lines/s':>10} {'peak MiB':>9}")
+    for name, r in results["corpora"].items():
+        base = (baseline or {}).get("corpora", {}).get(name)
+        row = f"{name:<14} {r['lines']:>7}"
+        for s in STAGES:
+            cell = f"{r[s] * 1e3:.1f}ms"
+            if base and base.get(s):
+                cell += f" {r[s] / base[s]:.2f}x"
+            row += f" {cell:>16}"
+        rate = r["parse_lines_per_s"]
+        row += f" {rate or 0:>10.0f} {r['peak_memory'] / 2 ** 20:>9.2f}"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scale", type=int, default=5000, help="lines per corpus")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=sorted(CORPORA), metavar="NAME")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    results = {
+        "scale": args.scale,
+        "repeats": args.repeats,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpora": {},
+    }
+    for name in args.only or CORPORA:
+        results["corpora"][name] = run_corpus(name, args.scale, args.repeats)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
 """Client for interacting with desmos."""
 import requests
 import os
-import base64
 import json
+import time
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import threading
 
+from .thumbnail import ThumbnailProvider
 
-try:
-    with open("thumb.png", "rb") as f:
-        thumb_data = "data:image/png;base64," + base64.b64encode(f.read()).decode()
-except:
-    raise OSError("Unable to open thumb.png, no image to use for thumbnail")
+
+# thumb.png is only read when a client first uploads with it
+default_thumbnails = ThumbnailProvider()
+
+
+def __getattr__(name):
+    if name == "thumb_data":
+        return default_thumbnails.get()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def check_status(r, expect=200):
@@ -37,13 +47,199 @@ headers = {
 }
 
 
+# Statuses worth retrying: rate limited or a server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+SaveResult = collections.namedtuple("SaveResult", ["graph_hash", "result", "error"])
+
+# Changes to a graph's expressions since its last upload, by id, and the size in
+#  bytes of the added and changed expressions' json
+ExpressionDiff = collections.namedtuple(
+    "ExpressionDiff", ["added", "changed", "removed", "size"]
+)
+SyncResult = collections.namedtuple("SyncResult", ["graph_hash", "result", "diff"])
+
+# calc_state keys that don't change what the graph shows, a graph is not uploaded
+#  again when only these differ
+NON_SEMANTIC_KEYS = {"randomSeed"}
+
+# diffs kept in the manifest for each graph
+HISTORY_SIZE = 20
+
+
+def canonical_json(data):
+    """Compact json with sorted keys, so equal graphs serialize identically"""
+    return json.dumps(data, separators=(",", ":"), sort_keys=True)
+
+
+def encoded_digests(expressions):
+    """Return the digest and size of each expression's json, from (id, json) pairs"""
+    digests = {}
+    for i, encoded in expressions:
+        encoded = encoded.encode()
+        digests[i] = (hashlib.sha1(encoded).hexdigest(), len(encoded))
+    return digests
+
+
+def expression_digests(data):
+    """Return the digest and json size of each expression in data, by id"""
+    return encoded_digests(
+        (exp["id"], canonical_json(exp))
+        for exp in data.get("expressions", {}).get("list", [])
+    )
+
+
+def state_digest(data, digests):
+    """Digest of everything in data that changes what the graph shows"""
+    rest = {
+        k: v
+        for k, v in data.items()
+        if k != "expressions" and k not in NON_SEMANTIC_KEYS
+    }
+    rest["expressions"] = [(i, d) for i, (d, _) in digests.items()]
+    return hashlib.sha256(canonical_json(rest).encode()).hexdigest()
+
+
+def diff_expressions(old, new):
+    """Compare expression digests from expression_digests, old being id: digest"""
+    added = [i for i in new if i not in old]
+    changed = [i for i in new if i in old and old[i] != new[i][0]]
+    removed = [i for i in old if i not in new]
+    size = sum(new[i][1] for i in added + changed)
+    return ExpressionDiff(added, changed, removed, size)
+
+
+class UploadManifest:
+    """Digest of the calc_state last uploaded to each graph hash, stored as json.
+
+    Also keeps the parent hash to pass when updating each graph, the digest of
+    each of its expressions and a history of the last uploads' diffs.
+    """
+
+    def __init__(self, path=".desmos-manifest.json"):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        # open batch blocks, and whether there are records to write when they end
+        self.batching = 0
+        self.dirty = False
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Write the manifest once when the block ends, instead of on each record"""
+        with self.lock:
+            self.batching += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batching -= 1
+                if not self.batching and self.dirty:
+                    self.write()
+
+    def is_unchanged(self, graph_hash, digest):
+        entry = self.entries.get(graph_hash)
+        return entry is not None and entry["digest"] == digest
+
+    def get_parent(self, graph_hash):
+        entry = self.entries.get(graph_hash)
+        return entry["parent_hash"] if entry is not None else None
+
+    def get_expressions(self, graph_hash):
+        """Return the digest of each expression last uploaded, by id"""
+        entry = self.entries.get(graph_hash)
+        return entry.get("expressions", {}) if entry is not None else {}
+
+    def get_history(self, graph_hash):
+        entry = self.entries.get(graph_hash)
+        return entry.get("history", []) if entry is not None else []
+
+    def record(self, graph_hash, digest, parent_hash, digests=None, diff=None):
+        with self.lock:
+            history = self.get_history(graph_hash)
+            if diff is not None:
+                history = history[1 - HISTORY_SIZE :] + [
+                    dict(diff._asdict(), time=int(time.time()))
+                ]
+            self.entries[graph_hash] = {
+                "digest": digest,
+                "parent_hash": parent_hash,
+                "expressions": {i: d for i, (d, _) in (digests or {}).items()},
+                "history": history,
+            }
+            self.dirty = True
+            if not self.batching:
+                self.write()
+
+    def write(self):
+        # called holding the lock
+        with open(self.path + ".tmp", "w") as f:
+            f.write(canonical_json(self.entries))
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+
 class DesmosClient:
-    def __init__(self):
+    def __init__(
+        self,
+        base_url="https://www.desmos.com",
+        pool_size=10,
+        retries=3,
+        backoff=0.5,
+        manifest=None,
+        thumbnails=None,
+        timeout=None,
+    ):
+        """manifest is an UploadManifest or its path, used to skip unchanged uploads.
+
+        thumbnails is the ThumbnailProvider for uploads, by default thumb.png.
+        timeout is passed to each request, in seconds.
+        """
+        if isinstance(manifest, str):
+            manifest = UploadManifest(manifest)
+        self.manifest = manifest
+        self.thumbnails = thumbnails or default_thumbnails
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
         self.s = requests.Session()
+        # one kept-alive connection per concurrent upload
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.s.mount("https://", adapter)
+        self.s.mount("http://", adapter)
+        # cancelled, the threading.Event set when the caller of the current
+        #  thread's call gave up on it, see check_cancelled
+        self.local = threading.local()
+
+    def check_cancelled(self):
+        """Raise CancelledError if the caller gave up on this thread's call"""
+        cancelled = getattr(self.local, "cancelled", None)
+        if cancelled is not None and cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+
+    def _post(self, path, **kwargs):
+        """POST to path, retrying with exponential backoff on 429 and 5xx responses"""
+        for attempt in range(self.retries + 1):
+            self.check_cancelled()
+            r = self.s.post(self.base_url + path, timeout=self.timeout, **kwargs)
+            if r.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return r
+            delay = self.backoff * 2 ** attempt
+            retry_after = r.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay)
 
     def login(self, email, password):
-        r = self.s.post(
-            "https://www.desmos.com/account/login_xhr",
+        r = self._post(
+            "/account/login_xhr",
             data={"email": email, "password": password},
             headers=headers,
         )
@@ -51,30 +247,108 @@ class DesmosClient:
         request_assert(r, r.text == "{}")
 
     def _save(self, data):
-        r = self.s.post("https://www.desmos.com/api/v1/calculator/save", data=data)
+        r = self._post("/api/v1/calculator/save", data=data)
         check_status(r)
         return r.json()
 
+    def _upload(self, data, graph_hash, parent_hash=None):
+        """Save data, returning the response and the ExpressionDiff since the last upload.
+
+        data is the calc_state dict, or its json from canonical_json (or
+        DesmosScript.dumps, which is the same) to upload without reserializing.
+        It can also be an encoded state with calc_state (that json), expressions
+        (each expression's id and json, as canonical_json encodes it) and other
+        (the calc_state's other keys), like DesmosScript.encode returns, which
+        is hashed without parsing the json back.
+        The response is None if the manifest shows nothing but NON_SEMANTIC_KEYS
+        changed, in which case nothing is uploaded. Desmos only saves whole
+        graphs, so anything else uploads all of data.
+        """
+        if hasattr(data, "calc_state"):
+            calc_state = data.calc_state
+            digests = encoded_digests(data.expressions)
+            digest = state_digest(data.other, digests)
+            # only parsed if a thumbnail is drawn from it
+            data = calc_state
+        else:
+            if isinstance(data, str):
+                calc_state = data
+                data = json.loads(data)
+            else:
+                calc_state = canonical_json(data)
+            digests = expression_digests(data)
+            digest = state_digest(data, digests)
+        old = {}
+        if self.manifest is not None:
+            old = self.manifest.get_expressions(graph_hash)
+        diff = diff_expressions(old, digests)
+        if self.manifest is not None and self.manifest.is_unchanged(graph_hash, digest):
+            return None, diff
+
+        form = {
+            "thumb_data": self.thumbnails.get(graph_hash, data),
+            "graph_hash": graph_hash,
+            "my_graphs": "true",
+            "is_update": "false" if parent_hash is None else "true",
+            "calc_state": calc_state,
+        }
+        if parent_hash is not None:
+            form["parent_hash"] = parent_hash
+            form["recovery_parent_hash"] = parent_hash
+        res = self._save(form)
+        # a save that landed after its caller gave up isn't recorded, so it is
+        #  uploaded again next time rather than skipped as unchanged
+        self.check_cancelled()
+        if self.manifest is not None:
+            # a created graph is the parent of its own updates
+            self.manifest.record(
+                graph_hash, digest, parent_hash or graph_hash, digests, diff
+            )
+        return res, diff
+
     def create(self, data, graph_hash):
-        return self._save(
-            {
-                "thumb_data": thumb_data,
-                "graph_hash": graph_hash,
-                "my_graphs": "true",
-                "is_update": "false",
-                "calc_state": json.dumps(data, separators=(",", ":")),
-            }
-        )
+        return self._upload(data, graph_hash)[0]
 
     def update(self, data, graph_hash, parent_hash):
-        return self._save(
-            {
-                "parent_hash": parent_hash,
-                "recovery_parent_hash": parent_hash,
-                "thumb_data": thumb_data,
-                "graph_hash": graph_hash,
-                "my_graphs": "true",
-                "is_update": "true",
-                "calc_state": json.dumps(data, separators=(",", ":")),
-            }
-        )
+        return self._upload(data, graph_hash, parent_hash)[0]
+
+    def sync(self, data, graph_hash, parent_hash=None):
+        """Save the graph like save, returning a SyncResult with its ExpressionDiff.
+
+        The diff is against the expressions last uploaded according to the
+        manifest, without one everything is added.
+        """
+        if parent_hash is None and self.manifest is not None:
+            parent_hash = self.manifest.get_parent(graph_hash)
+        res, diff = self._upload(data, graph_hash, parent_hash)
+        return SyncResult(graph_hash, res, diff)
+
+    def save(self, data, graph_hash, parent_hash=None):
+        """Create the graph, or update it if there is a parent_hash.
+
+        Without a parent_hash, the one recorded in the manifest is used. Returns
+        None if the manifest shows the same data was already uploaded.
+        """
+        return self.sync(data, graph_hash, parent_hash).result
+
+    def save_many(self, items, max_workers=8):
+        """Save many graphs concurrently over this client's session.
+
+        items are (data, graph_hash) or (data, graph_hash, parent_hash) tuples, see
+        save. Returns a SaveResult per item, in order, holding either the response
+        json (None if the upload was skipped) or the exception that item raised.
+        """
+        items = [tuple(i) for i in items]
+        manifest = self.manifest
+        # the manifest is written once, after every save has been recorded
+        batch = manifest.batch() if manifest is not None else contextlib.nullcontext()
+        with batch, concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(self.save, *i) for i in items]
+            results = []
+            for i, future in zip(items, futures):
+                try:
+                    results.append(SaveResult(i[1], future.result(), None))
+                except Exception as e:
+                    results.append(SaveResult(i[1], None, e))
+        return results
+
@@ -0,0 +1,103 @@
+"""asyncio interface to DesmosClient."""
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import threading
+
+from . import DesmosClient, SaveResult
+
+
+class AsyncDesmosClient:
+    """DesmosClient for asyncio code.
+
+    Requests are made by a DesmosClient on a thread pool the size of its
+    connection pool, so they don't block the event loop. At most max_in_flight
+    saves run at once; the rest wait without taking a thread, so they can be
+    cancelled cleanly. timeout bounds each call, retries included. When a call
+    times out or is cancelled, no further request (or retry) of it is started,
+    one already sent is abandoned, and the thread is freed once its own timeout
+    passes. A save that lands after that isn't recorded in the manifest, so the
+    next save of the graph uploads it again. Errors are raised as they are by
+    DesmosClient.
+    """
+
+    def __init__(self, max_in_flight=8, timeout=60, request_timeout=30, **kwargs):
+        """kwargs are passed to DesmosClient"""
+        self.client = DesmosClient(
+            pool_size=max_in_flight, timeout=request_timeout, **kwargs
+        )
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_in_flight)
+        # created on first use, so it belongs to the running loop
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Close the session once abandoned calls still using it have finished"""
+        loop = asyncio.get_running_loop()
+        # waited for on another thread, so the event loop isn't blocked
+        await loop.run_in_executor(None, self.executor.shutdown)
+        self.client.s.close()
+
+    def _call(self, cancelled, fn, *args):
+        self.client.local.cancelled = cancelled
+        try:
+            return fn(*args)
+        finally:
+            self.client.local.cancelled = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        call = functools.partial(self._call, cancelled, fn, *args)
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, call), self.timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            cancelled.set()
+            raise
+
+    async def _run_save(self, fn, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self.semaphore:
+            return await self._run(fn, *args)
+
+    async def login(self, email, password):
+        await self._run(self.client.login, email, password)
+
+    async def create(self, data, graph_hash):
+        return await self._run_save(self.client.create, data, graph_hash)
+
+    async def update(self, data, graph_hash, parent_hash):
+        return await self._run_save(self.client.update, data, graph_hash, parent_hash)
+
+    async def save(self, data, graph_hash, parent_hash=None):
+        return await self._run_save(self.client.save, data, graph_hash, parent_hash)
+
+    async def sync(self, data, graph_hash, parent_hash=None):
+        return await self._run_save(self.client.sync, data, graph_hash, parent_hash)
+
+    async def save_many(self, items):
+        """Save many graphs concurrently, see DesmosClient.save_many"""
+        items = [tuple(i) for i in items]
+        manifest = self.client.manifest
+        batch = manifest.batch() if manifest is not None else contextlib.nullcontext()
+        with batch:
+            results = await asyncio.gather(
+                *[self.save(*i) for i in items], return_exceptions=True
+            )
+        return [
+            SaveResult(i[1], None, r)
+            if isinstance(r, BaseException)
+            else SaveResult(i[1], r, None)
+            for i, r in zip(items, results)
+        ]
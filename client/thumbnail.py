@@ -0,0 +1,134 @@
+"""Graph thumbnails, loaded or drawn on first use and encoded once."""
+import base64
+import hashlib
+import json
+import struct
+import threading
+import zlib
+
+
+def png_data_uri(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
+
+def write_png(width, height, pixels):
+    """Encode a list of rows of (r, g, b) tuples as a png"""
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    # each row starts with filter type 0 (none)
+    raw = b"".join(b"\0" + bytes(c for px in row for c in px) for row in pixels)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def parse_color(color):
+    try:
+        return tuple(int(color[i : i + 2], 16) for i in (1, 3, 5))
+    except (TypeError, ValueError):
+        return (0, 0, 0)
+
+
+def draw_thumbnail(data, size=64):
+    """Draw a small png of a graph's axes and the colors of its expressions"""
+    viewport = data.get("graph", {}).get("viewport", {})
+    xmin, xmax = viewport.get("xmin", -10), viewport.get("xmax", 10)
+    ymin, ymax = viewport.get("ymin", -10), viewport.get("ymax", 10)
+    pixels = [[(255, 255, 255)] * size for _ in range(size)]
+
+    axis = (160, 160, 160)
+    if xmin < 0 < xmax:
+        col = int((0 - xmin) / (xmax - xmin) * (size - 1))
+        for row in pixels:
+            row[col] = axis
+    if ymin < 0 < ymax:
+        row = int((ymax - 0) / (ymax - ymin) * (size - 1))
+        pixels[row] = [axis] * size
+
+    # a band along the bottom with a stripe per expression color
+    colors = [
+        parse_color(e["color"])
+        for e in data.get("expressions", {}).get("list", [])
+        if e.get("type") == "expression" and not e.get("hidden") and "color" in e
+    ]
+    band = max(size // 8, 1)
+    for x in range(size if colors else 0):
+        color = colors[x * len(colors) // size]
+        for y in range(size - band, size):
+            pixels[y][x] = color
+    return write_png(size, size, pixels)
+
+
+class ThumbnailProvider:
+    """Thumbnails for uploads as base64 data uris.
+
+    Each image file is read and encoded once, then shared by every upload that
+    uses it. graph hashes can be given their own file with set_thumbnail. With
+    generate, graphs without one get a thumbnail drawn from their calc_state.
+    """
+
+    def __init__(self, path="thumb.png", generate=False, size=64):
+        self.path = path
+        self.generate = generate
+        self.size = size
+        self.per_graph = {}
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+    def set_thumbnail(self, graph_hash, path):
+        self.per_graph[graph_hash] = path
+
+    def load(self, path):
+        uri = self.encoded.get(path)
+        if uri is None:
+            try:
+                with open(path, "rb") as f:
+                    png = f.read()
+            except OSError:
+                raise OSError(f"Unable to open {path}, no image to use for thumbnail")
+            with self.lock:
+                uri = self.encoded.setdefault(path, png_data_uri(png))
+        return uri
+
+    def draw(self, data):
+        # only what's drawn goes in the key, so unrelated edits reuse the image
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    data.get("graph", {}).get("viewport"),
+                    [
+                        (e.get("color"), e.get("hidden"))
+                        for e in data.get("expressions", {}).get("list", [])
+                        if e.get("type") == "expression"
+                    ],
+                    self.size,
+                ],
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+        uri = self.encoded.get(key)
+        if uri is None:
+            uri = png_data_uri(draw_thumbnail(data, self.size))
+            with self.lock:
+                uri = self.encoded.setdefault(key, uri)
+        return uri
+
+    def get(self, graph_hash=None, data=None):
+        """Return the thumbnail data uri to upload with a graph"""
+        if graph_hash in self.per_graph:
+            return self.load(self.per_graph[graph_hash])
+        if self.generate and data is not None:
+            if isinstance(data, str):
+                data = json.loads(data)
+            return self.draw(data)
+        return self.load(self.path)
@@ -1,12 +1,19 @@
 """DesmosScript Compiler"""
 import re
-import regex
 import shlex
-import json
 import random
 import abc
+import collections
+import concurrent.futures
 import os
 import sys
+import time
+
+from .buildcache import hash_file
+from . import dlib
+from . import serialize
+from .diagnostics import Diagnostics, format_trace, to_json_records
+from .profiling import Profiler
 
 
 STANDARD_LIBRARY = {
@@ -30,39 +37,344 @@ STANDARD_LIBRARY = {
         r"f_{ill}\left(l_{enfill},v_{fill}\right)=f_{illa}\left(\left[1,...l_{enfill}\right],v_{fill}\right)",
     ],
     "assign": [
-        r"a_{ssigna}\left(l_{asn},i_{asn},v_{asn},t_{asn}\right)=\sum_{n=t_{asn}}^{t_{asn}}\left\{i_{asn}=n:v_{asn},l_{asn}\left[n\right]\right\}"
+        r"a_{ssigna}\left(l_{asn},i_{asn},v_{asn},t_{asn}\right)=\sum_{n=t_{asn}}^{t_{asn}}\left\{i_{asn}=n:v_{asn},l_{asn}\left[n\right]\right\}",
         r"a_{ssign}\left(l_{asn},i_{asn},v_{asn}\right)=a_{ssigna}\left(l_{asn},i_{asn},v_{asn},\left[1,...,\operatorname{length}\left(l_{asn}\right)\right]\right)",
     ],
 }
 
 
+class LRUCache:
+    """Least recently used cache counting hits and misses, disabled by maxsize 0"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if not self.maxsize:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.entries) > maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Results of replace_ifs and convert_to_latex, which see the same text over and
+#  over in generated scripts
+IF_CACHE = LRUCache(1024)
+LATEX_CACHE = LRUCache(4096)
+
+
+def cache_stats():
+    return {"replace_ifs": IF_CACHE.stats(), "convert_to_latex": LATEX_CACHE.stats()}
+
+
+def clear_caches():
+    """Empty the conversion caches and reset their counters"""
+    IF_CACHE.clear()
+    LATEX_CACHE.clear()
+
+
 def make_cond(cond, trueres, falseres):
     falseres = ',' + falseres if falseres else ''
     return "{" + cond + ":" + trueres + falseres + "}"
 
 
 def make_and_exp(conda, condb, trueres, falseres):
-    return make_cond(conda, make_cond(condb, trueres, falseres), falseres)
+    return cond_replacer(conda, cond_replacer(condb, trueres, falseres), falseres)
 
 
 def make_or_exp(conda, condb, trueres, falseres):
-    return make_cond(conda, trueres, make_cond(condb, trueres, falseres))
+    return cond_replacer(conda, trueres, cond_replacer(condb, trueres, falseres))
+
+
+BRACKET_OPEN = "([{"
+BRACKET_CLOSE = ")]}"
+COND_SPLIT_RE = re.compile(r"[()\[\]{}]| or | and ")
+
+
+def split_top_level(st, sep):
+    """Split st on sep, ignoring occurrences inside brackets"""
+    parts = []
+    depth = 0
+    last = 0
+    for m in COND_SPLIT_RE.finditer(st):
+        tok = m.group()
+        if tok in BRACKET_OPEN:
+            depth += 1
+        elif tok in BRACKET_CLOSE:
+            depth = max(depth - 1, 0)
+        elif tok == sep and depth == 0:
+            parts.append(st[last : m.start()])
+            last = m.end()
+    parts.append(st[last:])
+    return parts
 
 
 def cond_replacer(cond, trueres, falseres):
-    for op, op_f in {"and": make_and_exp, "or": make_or_exp}.items():
-        split = cond.split(f" {op} ")
-        if len(split) != 2:
+    # 'and' binds tighter than 'or', so the condition is split on 'or' first
+    for op, op_f in (("or", make_or_exp), ("and", make_and_exp)):
+        split = split_top_level(cond, f" {op} ")
+        if len(split) < 2:
             continue
-        conda, condb = split
-        res = op_f(conda, condb, trueres, falseres)
-        return res
+        conda, condb = split[0], f" {op} ".join(split[1:])
+        return op_f(conda, condb, trueres, falseres)
+
+    # (a or b) and c
+    if cond.startswith("(") and cond.endswith(")"):
+        inner = cond[1:-1]
+        if split_top_level(inner, " or ")[1:] or split_top_level(inner, " and ")[1:]:
+            return cond_replacer(inner, trueres, falseres)
     return make_cond(cond, trueres, falseres)
 
-    # re.sub(r'\((.*?)\)', lambda cm: operation_replacer(cm.group(1)), cond)
+
+IF_START_RE = re.compile(r"\|if ?\(")
+IF_THEN_RE = re.compile(r" ?then ?")
+IF_TOKEN_RE = re.compile(r"\|if ?\(|[()\[\]{}|]| else ")
+
+
+# The tokens ending each part of an if statement: its condition, the then branch
+#  and the else branch
+IF_END_TOKENS = ((")",), ("|", " else "), ("|",))
+
+
+class IfFrame:
+    """An if statement being parsed by parse_if"""
+
+    __slots__ = ("start", "pos", "depth", "parts", "done")
+
+    def __init__(self, l, start):
+        self.start = start
+        self.pos = IF_START_RE.match(l, start).end()
+        self.depth = 0
+        # text of the current part so far, and the finished parts
+        self.parts = []
+        self.done = []
+
+
+def parse_if(l, start, memo=None):
+    """Parse the '|if (<cond>) then <a> else <b>|' at start.
+
+    Returns the desmos piecewise and the position after the closing |, or None if
+    there isn't a valid if statement there, which is also the case when an if
+    statement inside it isn't. Nested ifs are parsed on a stack rather than by
+    recursion, and memo maps each start position tried to its result, so every
+    token is scanned once however deeply the ifs nest.
+    """
+    if memo is None:
+        memo = {}
+    if start in memo:
+        return memo[start]
+    stack = [IfFrame(l, start)]
+    while stack:
+        f = stack[-1]
+        m = IF_TOKEN_RE.search(l, f.pos)
+        if m is None:
+            memo[f.start] = None
+            stack.pop()
+            continue
+        tok = m.group()
+        pos = m.start()
+        if tok[-1] == "(" and tok[0] == "|":
+            if pos not in memo:
+                stack.append(IfFrame(l, pos))
+                continue
+            nested = memo[pos]
+            if nested is not None:
+                f.parts.append(l[f.pos : pos])
+                f.parts.append(nested[0])
+                f.pos = nested[1]
+                continue
+            # an if statement inside this one is unclosed, so this one is too
+            memo[f.start] = None
+            stack.pop()
+            continue
+        if f.depth == 0 and tok in IF_END_TOKENS[len(f.done)]:
+            f.parts.append(l[f.pos : pos])
+            f.done.append("".join(f.parts))
+            f.parts = []
+            if len(f.done) == 1:
+                m = IF_THEN_RE.match(l, pos + 1)
+                if m is None:
+                    memo[f.start] = None
+                    stack.pop()
+                else:
+                    f.pos = m.end()
+                continue
+            if tok == " else ":
+                f.pos = pos + len(tok)
+                continue
+            cond, trueres = f.done[:2]
+            falseres = f.done[2] if len(f.done) > 2 else None
+            memo[f.start] = (cond_replacer(cond, trueres, falseres), pos + 1)
+            stack.pop()
+            continue
+        if tok in BRACKET_OPEN:
+            f.depth += 1
+        elif tok in BRACKET_CLOSE:
+            f.depth = max(f.depth - 1, 0)
+        end = pos + len(tok)
+        f.parts.append(l[f.pos : end])
+        f.pos = end
+    return memo[start]
+
+
+def replace_ifs(l):
+    """Rewrite every if statement in l to a desmos piecewise, cached in IF_CACHE"""
+    if "|if" not in l:
+        return l
+    res = IF_CACHE.get(l)
+    if res is None:
+        res = replace_ifs_uncached(l)
+        IF_CACHE.put(l, res)
+    return res
+
+
+def replace_ifs_uncached(l):
+    """Rewrite every if statement in l to a desmos piecewise, in one pass"""
+    if "|if" not in l:
+        return l
+    parts = []
+    pos = 0
+    memo = {}
+    for m in IF_START_RE.finditer(l):
+        if m.start() < pos:
+            # inside an if statement that was already rewritten
+            continue
+        res = parse_if(l, m.start(), memo)
+        if res is not None:
+            parts.append(l[pos : m.start()])
+            parts.append(res[0])
+            pos = res[1]
+    parts.append(l[pos:])
+    return "".join(parts)
+
+
+BUILTINS = (
+    "polygon|sin|cos|tan|csc|sec|cot|arcsin|arccos|arctan|arccsc|arcsec|arccot|sinh"
+    "|cosh|tanh|csch|sech|coth|total|min|max|length|mean|median|quantile|stdev|stdevp"
+    "|mad|var|cov|corr|nCr|nPr|lcm|gcd|mod|floor|ceil|round|abs|sign|nthroot|exp|ln"
+    "|log|log_a"
+)
+
+FRAC_RE = re.compile(r"frac\((.+?),(.+?)\)")
+# Everything that convert_to_latex rewrites, in the precedence the old
+#  chain of replaces gave it. '*' swallows the letters after it like '\cdot' did.
+LATEX_TOKEN_RE = re.compile(
+    r"[{}()\[\]]+|\\[a-zA-Z]+|\*[a-zA-Z]*|(?:"
+    + BUILTINS
+    + r")|[a-zA-Z][a-zA-Z0-9]+|<=|>="
+)
+BUILTIN_NAMES = frozenset(BUILTINS.split("|"))
+BRACKET_TRANSLATION = str.maketrans(
+    {
+        "{": r"\left\{",
+        "}": r"\right\}",
+        "(": r"\left(",
+        ")": r"\right)",
+        "[": r"\left[",
+        "]": r"\right]",
+    }
+)
+
+
+class LatexTokenTable(dict):
+    """Maps source tokens to their latex, converting on first lookup"""
+
+    MAX_SIZE = 8192
+
+    def __missing__(self, tok):
+        c = tok[0]
+        if c in "{}()[]":
+            res = tok.translate(BRACKET_TRANSLATION)
+        elif c == "<":
+            res = "\\le "
+        elif c == ">":
+            res = "\\ge "
+        elif c == "*":
+            res = r"\cdot" + tok[1:]
+        elif c == "\\":
+            res = tok
+        elif tok in BUILTIN_NAMES:
+            res = r"\operatorname{" + tok + "}"
+        else:
+            # multi-letter variable
+            res = c + "_{" + tok[1:] + "}"
+        if "polygon" in res:
+            res = res.replace("polygon", r"\operatorname{polygon}")
+        if len(self) < self.MAX_SIZE:
+            self[tok] = res
+        return res
+
+
+LATEX_TOKENS = LatexTokenTable()
+
+
+def emit_latex_token(m):
+    return LATEX_TOKENS[m.group()]
 
 
 def convert_to_latex(st):
+    """Convert a DesmosScript expression to desmos latex, cached in LATEX_CACHE"""
+    # spaces are dropped by the conversion anyway
+    st = st.replace(" ", "")
+    res = LATEX_CACHE.get(st)
+    if res is None:
+        res = convert_to_latex_uncached(st)
+        LATEX_CACHE.put(st, res)
+    return res
+
+
+def convert_to_latex_uncached(st):
+    """Convert a DesmosScript expression to desmos latex in a single tokenizing pass"""
+    st = st.replace(" ", "")
+    if "frac(" not in st:
+        return LATEX_TOKEN_RE.sub(emit_latex_token, st)
+
+    # fractions are matched first so their arguments can't merge into a variable
+    out = []
+    pos = 0
+    for m in FRAC_RE.finditer(st):
+        out.append(LATEX_TOKEN_RE.sub(emit_latex_token, st[pos : m.start()]))
+        out.append(r"\frac{")
+        out.append(LATEX_TOKEN_RE.sub(emit_latex_token, m.group(1)))
+        out.append("}{")
+        out.append(LATEX_TOKEN_RE.sub(emit_latex_token, m.group(2)))
+        out.append("}")
+        pos = m.end()
+    out.append(LATEX_TOKEN_RE.sub(emit_latex_token, st[pos:]))
+    return "".join(out)
+
+
+def convert_to_latex_legacy(st):
+    """Multi-pass reference implementation of convert_to_latex, kept for benchmarks"""
     st = (
         st.replace("{", r"\left\{")
         .replace("}", r"\right\}")
@@ -94,15 +406,131 @@ def convert_to_latex(st):
     )
 
 
+class ExpressionRecord:
+    """A graph expression, converted to the desmos json dict by to_dict.
+
+    Supports dict style item access so statements can modify the last expression.
+    Field names match the desmos json keys, unset fields are None and left out.
+    """
+
+    FIELDS = (
+        "type",
+        "text",
+        "title",
+        "collapsed",
+        "color",
+        "latex",
+        "folderId",
+        "id",
+        "slider",
+        "dragMode",
+        "hidden",
+        "showLabel",
+        "label",
+        "labelOrientation",
+    )
+    # package is the name of the include that added the expression, if any, and
+    #  definition its latex_definition when it came from a .dlib's exports
+    __slots__ = FIELDS + ("extra", "package", "definition")
+
+    def __init__(
+        self, type, color=None, latex=None, folderId=None, text=None, title=None
+    ):
+        self.type = sys.intern(type)
+        self.text = text
+        self.title = title
+        self.color = None if color is None else sys.intern(color)
+        self.latex = latex
+        self.folderId = None if folderId is None else sys.intern(folderId)
+        self.id = None
+        self.collapsed = self.slider = self.dragMode = self.hidden = None
+        self.showLabel = self.label = self.labelOrientation = None
+        # keys desmos supports that have no field, only allocated when used
+        self.extra = None
+        self.package = self.definition = None
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        exp = cls(data.pop("type"))
+        for k, v in data.items():
+            exp[k] = v
+        return exp
+
+    def __getitem__(self, key):
+        if key in FIELD_NAMES:
+            v = getattr(self, key)
+        else:
+            v = self.extra.get(key) if self.extra else None
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, value):
+        if key in INTERNED_FIELDS and value is not None:
+            value = sys.intern(value)
+        if key in FIELD_NAMES:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        d = {}
+        for k in self.FIELDS:
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def to_json(self):
+        return encode_record(self)
+
+
+FIELD_NAMES = frozenset(ExpressionRecord.FIELDS)
+encode_record = serialize.make_record_encoder(ExpressionRecord.FIELDS)
+INTERNED_FIELDS = frozenset(["type", "color", "folderId"])
+
+
 class Statement(abc.ABC):
+    # Line prefixes this statement can match, used to index DesmosScript's
+    #  dispatch table. Statements without prefixes are tried on every line.
+    PREFIXES = ()
+    # Whether the statement changes the last expression rather than adding one
+    MODIFIES_LAST = False
+
     @staticmethod
     @abc.abstractmethod
     def parse(graph, l):
         """Return True if line parsed, False if parser should try next statement"""
         return False
 
+    @classmethod
+    def get_prefixes(cls):
+        return cls.PREFIXES
+
 
 class PrefixedStatement(Statement):
+    @classmethod
+    def get_prefixes(cls):
+        return (cls.PREFIX,)
+
     @classmethod
     def parse(cls, graph, l):
         if l.startswith(cls.PREFIX):
@@ -128,8 +556,7 @@ class Note(PrefixedStatement):
 
     @staticmethod
     def process(graph, l):
-        folder_data = {"folderId": graph.folder} if graph.folder else {}
-        graph.add_exp({"type": "text", "text": l[2:], **folder_data})
+        graph.add_exp(ExpressionRecord("text", text=l[2:], folderId=graph.folder))
         return True
 
 
@@ -149,16 +576,18 @@ class Color(PrefixedStatement):
             or len(newcolor) != 7
             or not cls.is_valid_color(newcolor)
         ):
-            graph.warn(f"Invalid color statement {l!r}")
+            graph.warn(f"Invalid color statement {l!r}", code="color")
         else:
             graph.color = newcolor
         return True
 
 
 class Bounds(Statement):
+    PREFIXES = ("xbounds ", "ybounds ")
+
     @classmethod
     def parse(cls, graph, l):
-        if l.startswith("xbounds ") or l.startswith("ybounds "):
+        if l.startswith(cls.PREFIXES):
             return cls.process(graph, l)
 
     @staticmethod
@@ -172,13 +601,14 @@ class Bounds(Statement):
             newviewport[axe + "min"] = float(vmin)
             newviewport[axe + "max"] = float(vmax)
         except ValueError:
-            graph.warn(f"Syntax Error: Invalid bound statement: {l!r}")
+            graph.warn(f"Syntax Error: Invalid bound statement: {l!r}", code="bounds")
         graph.viewport = newviewport
         return True
 
 
 class Slider(PrefixedStatement):
     PREFIX = "slider "
+    MODIFIES_LAST = True
 
     LOOP_DIRECTIONS = {
         "back_and_forth": None,
@@ -189,20 +619,24 @@ class Slider(PrefixedStatement):
     @classmethod
     def process(cls, graph, l):
         if len(graph.explist) < 1 or graph.explist[-1]["type"] != "expression":
-            graph.warn(f"Syntax Error: slider statement must follow an expression")
+            graph.warn(
+                f"Syntax Error: slider statement must follow an expression",
+                code="slider",
+            )
         args = l.split(" ")
         if len(args) < 4 or args[2] != "to":
             graph.warn(
                 f"Syntax Error: slider statement should be in the form of "
-                "'slider x to x'"
+                "'slider x to x'",
+                code="slider",
             )
             return True
         last = graph.explist[-1]
         last["slider"] = {
             "hardMin": True,
             "hardMax": True,
-            "min": convert_to_latex(args[1]),
-            "max": convert_to_latex(args[3]),
+            "min": graph.timed("convert_to_latex", convert_to_latex, args[1]),
+            "max": graph.timed("convert_to_latex", convert_to_latex, args[3]),
         }
         if len(args) >= 5:
             i = 4
@@ -217,7 +651,8 @@ class Slider(PrefixedStatement):
                     except IndexError:
                         graph.warn(
                             f"Syntax Error: Expected a step after 'step' in "
-                            "slider statement"
+                            "slider statement",
+                            code="slider",
                         )
                         return True
                     i += 1
@@ -229,13 +664,14 @@ class Slider(PrefixedStatement):
                 elif arg == "playing":
                     last["slider"]["isPlaying"] = True
                 else:
-                    graph.warn(f"Ignoring unrecognized slider arg {arg}")
+                    graph.warn(f"Ignoring unrecognized slider arg {arg}", code="slider")
                 i += 1
         return True
 
 
 class Draggable(PrefixedStatement):
     PREFIX = "draggable"
+    MODIFIES_LAST = True
 
     VALID_TYPES = ["X", "Y", "XY", "NONE"]
 
@@ -243,11 +679,12 @@ class Draggable(PrefixedStatement):
     def process(cls, graph, l):
         args = l.split(" ")
         if len(args) < 2:
-            graph.warn("Expected draggable type")
+            graph.warn("Expected draggable type", code="draggable")
         drag_mode = args[1]
         if drag_mode not in cls.VALID_TYPES:
             graph.warn(
-                f"Invalid draggable type, must be one of {', '.join(cls.VALID_TYPES)}"
+                f"Invalid draggable type, must be one of {', '.join(cls.VALID_TYPES)}",
+                code="draggable",
             )
         # TODO: check if last is a point, maybe separate point expression that contains the default drag mode (NONE)
         graph.explist[-1]["dragMode"] = drag_mode
@@ -256,6 +693,7 @@ class Draggable(PrefixedStatement):
 
 class Hidden(PrefixedStatement):
     PREFIX = "hidden"
+    MODIFIES_LAST = True
 
     @staticmethod
     def process(graph, l):
@@ -265,12 +703,13 @@ class Hidden(PrefixedStatement):
 
 class Label(PrefixedStatement):
     PREFIX = "label "
+    MODIFIES_LAST = True
 
     @staticmethod
     def process(graph, l):
         args = l.split(" ")
         if len(args) < 2:
-            graph.warn("Expected label value")
+            graph.warn("Expected label value", code="label")
         graph.explist[-1]["showLabel"] = True
         graph.explist[-1]["label"] = ' '.join(args[1:])
         return True
@@ -278,6 +717,7 @@ class Label(PrefixedStatement):
 
 class LabelOptions(PrefixedStatement):
     PREFIX = "labelopts "
+    MODIFIES_LAST = True
 
     OPTIONS = {
       d: ("labelOrientation", d) for d in ["left", "right", "above", "below"]
@@ -291,7 +731,7 @@ class LabelOptions(PrefixedStatement):
                 k, v = cls.OPTIONS[a]
                 graph.explist[-1][k] = v
             else:
-                graph.warn(f"Unrecognized label option {a}, ignoring")
+                graph.warn(f"Unrecognized label option {a}, ignoring", code="labelopts")
         return True
 
 
@@ -301,25 +741,29 @@ class Folder(PrefixedStatement):
     @classmethod
     def process(cls, graph, l):
         if l.startswith("folder-closed "):
-            extra = {"collapsed": True}
+            collapsed = True
         elif l.startswith("folder "):
-            extra = {}
+            collapsed = None
         else:
             graph.warn(
                 f"Syntax Error: 'folder' statement must start with 'folder '"
-                " or 'folder-closed ', ignoring"
+                " or 'folder-closed ', ignoring",
+                code="folder",
             )
             return True
 
         _, _, folder_title = l.partition(" ")
         if not folder_title:
-            print(
-                f"WARN: Syntax Error: Expected folder title in 'folder' statement, ignoring"
+            graph.warn(
+                "Syntax Error: Expected folder title in 'folder' statement, ignoring",
+                code="folder",
             )
             return True
 
-        graph.add_exp({"type": "folder", "title": folder_title, **extra})
-        graph.folder = str(graph.exp_id)
+        folder = ExpressionRecord("folder", title=folder_title)
+        folder.collapsed = collapsed
+        graph.add_exp(folder)
+        graph.folder = sys.intern(folder.id)
         return True
 
 
@@ -332,86 +776,576 @@ class EndFolder(PrefixedStatement):
         return True
 
 
+class PackageCache(LRUCache):
+    """LRU cache of compiled .dscript packages, keyed by resolved path, mtime and size"""
+
+    @staticmethod
+    def make_key(path):
+        st = os.stat(path)
+        return (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+
 class Include(PrefixedStatement):
     PREFIX = "include"
 
+    # shared by every graph in the process
+    PACKAGE_CACHE = PackageCache()
+    # sha256 of the sources .dlib files were packed from, by PackageCache key
+    SOURCE_HASHES = PackageCache(1024)
+
     @staticmethod
-    def load_pkg(graph, name):
+    def replay_warnings(graph, warnings):
+        """Raise the warnings a package raised when it was compiled, through graph"""
+        if warnings:
+            graph.update_callstack()
+            graph.diagnostics.replay(warnings, graph.callstack)
+
+    @classmethod
+    def compile_pkg(cls, graph, fname):
+        """Return a package's latex, the files it includes and the warnings it raised"""
+        build_cache = graph.build_cache
+        meta = build_cache.load(fname) if build_cache is not None else None
+        if meta is not None:
+            includes = tuple(sorted(meta["includes"]))
+            for n in (fname,) + includes:
+                graph.check_circular(n)
+            warnings = meta.get("warnings", [])
+            cls.replay_warnings(graph, warnings)
+            return tuple(build_cache.read_statements(fname)), includes, warnings
+
+        source_hash = hash_file(fname) if build_cache is not None else None
+        g = graph.make_child_graph(fname)
+        with graph.diagnostics.recording() as raised, open(fname, "r") as f:
+            g.parse_stream(f)
+        # kept relative to the package, since it can be included from anywhere
+        warnings = to_json_records(raised, len(graph.callstack))
+        statements = tuple(g.get_latex_statements())
+        if build_cache is not None:
+            build_cache.store(
+                fname, source_hash, g.includes, statements=statements, warnings=warnings
+            )
+        return statements, tuple(sorted(g.includes)), warnings
+
+    @classmethod
+    def source_changed(cls, path, digest):
+        """Whether path exists and its content doesn't hash to digest"""
+        if not os.path.exists(path):
+            return False
+        key = cls.SOURCE_HASHES.make_key(path)
+        current = cls.SOURCE_HASHES.get(key)
+        if current is None:
+            current = hash_file(path)
+            cls.SOURCE_HASHES.put(key, current)
+        return current != digest
+
+    @classmethod
+    def load_dlib(cls, graph, path, source):
+        """Return the statements and exports of a packed package.
+
+        Returns None if its sources changed, and raises ValueError if it can't
+        be read.
+        """
+        cache = cls.PACKAGE_CACHE
+        key = cache.make_key(path)
+        cached = cache.get(key)
+        if cached is None:
+            header, statements = dlib.read_dlib(path)
+            # the hashes of the source and the files it includes when packed
+            hashes = tuple(sorted(header["includes"].items()))
+            exports = tuple(
+                (name, frozenset(names)) for name, names in header["exports"]
+            )
+            cached = (statements, hashes, exports)
+            cache.put(key, cached)
+        statements, hashes, exports = cached
+        if any(cls.source_changed(n, digest) for n, digest in hashes):
+            return None
+        includes = tuple(n for n, _ in hashes)
+        for n in (source,) + includes:
+            graph.check_circular(n)
+        # so the build cache and watch mode see changes to the sources too
+        graph.includes.add(path)
+        graph.includes.update(includes)
+        return statements, exports
+
+    @classmethod
+    def load_pkg(cls, graph, name):
+        """Return a package's latex statements and, if it was packed, their exports"""
         if name in STANDARD_LIBRARY:
-            return STANDARD_LIBRARY[name]
-        elif os.path.exists(name + ".dscript"):
-            g = graph.make_child_graph(name + ".dscript")
-            with open(name + ".dscript", "r") as f:
-                g.parse(f.read())
-            return g.get_latex_statements()
-        print("bruh")
+            return STANDARD_LIBRARY[name], None
+        fname = name + ".dscript"
+        path = name + dlib.EXT
+        if os.path.exists(path):
+            try:
+                packed = cls.load_dlib(graph, path, fname)
+            except (ValueError, KeyError) as e:
+                graph.warn(f"Unable to read {path} ({e}), using {fname}", code="dlib")
+            else:
+                if packed is not None:
+                    return packed
+                graph.warn(
+                    f"{path} was packed from different sources, using {fname}",
+                    code="dlib",
+                )
+        if os.path.exists(fname):
+            cache = cls.PACKAGE_CACHE
+            key = cache.make_key(fname)
+            cached = cache.get(key)
+            if cached is not None:
+                statements, includes, include_keys, warnings = cached
+                # the package is stale if anything it includes changed
+                if not all(
+                    os.path.exists(n) and cache.make_key(n) == k
+                    for n, k in zip(includes, include_keys)
+                ):
+                    cached = None
+            if cached is not None:
+                # the package's own includes could now be circular too
+                for n in (fname,) + includes:
+                    graph.check_circular(n)
+                cls.replay_warnings(graph, warnings)
+            else:
+                statements, includes, warnings = cls.compile_pkg(graph, fname)
+                include_keys = tuple(cache.make_key(n) for n in includes)
+                cache.put(key, (statements, includes, include_keys, warnings))
+            graph.includes.update((fname,) + includes)
+            return statements, None
 
     @classmethod
     def process(cls, graph, l):
         args = shlex.split(l)
         if len(args) < 2:
-            graph.warn("Ignoring invalid include statement")
+            graph.warn("Ignoring invalid include statement", code="include")
             return True
         pkgname = args[1]
-        pkg = cls.load_pkg(graph, pkgname)
+        pkg = graph.timed("include " + pkgname, cls.load_pkg, graph, pkgname)
         if pkg is None:
-            graph.warn(f"Unable to find package {pkgname!r}")
+            graph.warn(f"Unable to find package {pkgname!r}", code="include")
             return True
 
-        folder_data = {"folderId": graph.folder} if graph.folder else {}
-        for s in pkg:
-            graph.add_exp(
-                {"type": "expression", "color": graph.color, "latex": s, **folder_data}
+        statements, exports = pkg
+        for i, s in enumerate(statements):
+            exp = ExpressionRecord(
+                "expression", color=graph.color, latex=s, folderId=graph.folder
             )
+            exp.package = pkgname
+            if exports is not None:
+                exp.definition = exports[i]
+            graph.add_exp(exp)
 
         return True
 
 
+# expressions sent to a worker at a time when converting in parallel, and the
+#  fewest worth starting worker processes for
+CONVERT_CHUNK = 512
+
+
+def convert_expressions(lines):
+    """Return the latex of expression lines, as Expression.parse converts them"""
+    return [convert_to_latex(replace_ifs(l)) for l in lines]
+
+
 class Expression(Statement):
     @staticmethod
     def parse(graph, l):
-        did_match = True
-        sub = lambda s: regex.sub(
-            r"\|if(?: ?)\((.+?)\)(?: ?)then(?: ?)(?:((?R))|(.+?))(?:(?: else )(?:((?R))|(.+)))?\|",
-            replace_ifs,
-            s,
+        if graph.jobs is not None and graph.jobs > 1:
+            # converted later by graph.convert_pending
+            exp = ExpressionRecord(
+                "expression", color=graph.color, folderId=graph.folder
+            )
+            graph.add_exp(exp)
+            graph.defer_expression(exp, l)
+            return
+        l = graph.timed("replace_ifs", replace_ifs, l)
+        graph.add_exp(
+            ExpressionRecord(
+                "expression",
+                color=graph.color,
+                latex=graph.timed("convert_to_latex", convert_to_latex, l),
+                folderId=graph.folder,
+            )
         )
 
-        while did_match:
-            did_match = False
-            # print("subbing", l)
 
-            def replace_ifs(m):
-                nonlocal did_match
-                did_match = True
-                cond, truerecurse, trueres, falserecurse, falseres = m.groups()
+# Names in desmos latex, skipping commands and operatorname functions
+LATEX_NAME_RE = re.compile(
+    r"\\operatorname\{[a-zA-Z]+\}|\\[a-zA-Z]+|([a-zA-Z](?:_\{[a-zA-Z0-9]+\}|_[a-zA-Z0-9])?)"
+)
+DEFINITION_RE = re.compile(
+    r"([a-zA-Z](?:_\{[a-zA-Z0-9]+\}|_[a-zA-Z0-9])?)(?:\\left\((.*)\\right\))?$"
+)
+# Names that make an equation a plot instead of a definition
+PLOT_NAMES = frozenset(["x", "y", "r"])
 
-                if truerecurse:
-                    trueres = sub(truerecurse)
-                if falserecurse:
-                    falseres = sub(falserecurse)
 
-                res = cond_replacer(cond, trueres, falseres)
-                # print("result:", res)
-                return res
+def latex_names(latex):
+    return {m.group(1) for m in LATEX_NAME_RE.finditer(latex) if m.group(1)}
 
-            l = sub(l)
 
-        folder_data = {"folderId": graph.folder} if graph.folder else {}
-        graph.add_exp(
-            {
-                "type": "expression",
-                "color": graph.color,
-                "latex": convert_to_latex(l),
-                **folder_data,
-            }
+def parse_definition(latex):
+    """Return the name a latex expression defines and the names it uses, or None"""
+    lhs, eq, rhs = latex.partition("=")
+    m = DEFINITION_RE.match(lhs) if eq else None
+    if m is None or m.group(1) in PLOT_NAMES:
+        return None
+    # function parameters are local
+    return m.group(1), latex_names(rhs) - latex_names(m.group(2) or "")
+
+
+def latex_definition(latex):
+    """Return the name latex defines, or None, and the names it uses"""
+    definition = parse_definition(latex)
+    if definition is None:
+        return None, latex_names(latex)
+    return definition
+
+
+def record_definition(exp):
+    """latex_definition of exp's latex, from the .dlib's exports if it has them"""
+    if exp.definition is None:
+        return latex_definition(exp.latex)
+    name, names = exp.definition
+    return name, set(names)
+
+
+def expression_names(exp, latex=None):
+    """Names used by an expression, in its latex (or latex), slider bounds and label"""
+    names = set()
+    for text in (exp.latex if latex is None else latex, exp.label):
+        if text:
+            names |= latex_names(text)
+    if exp.slider:
+        for v in exp.slider.values():
+            if isinstance(v, str):
+                names |= latex_names(v)
+    return names
+
+
+def is_prunable(exp, prune):
+    return exp.package is not None and (
+        prune == "all" or (prune == "stdlib" and exp.package in STANDARD_LIBRARY)
+    )
+
+
+def is_deferred(exp, prune):
+    """Whether exp is output after the rest of the graph, see prune_unused"""
+    return exp.folderId is None and is_prunable(exp, prune)
+
+
+def prune_unused(explist, prune="stdlib", used=()):
+    """Return explist without the definitions from includes nothing references.
+
+    prune is "stdlib" to only remove standard library definitions, "all" for
+    those of any include, or None to keep everything. used is names referenced
+    from outside explist. Definitions needed by a used one are kept too.
+    The expressions prune could remove that aren't in a folder are moved after
+    the rest, so compile_stream can write the rest before knowing which are used.
+    """
+    if prune is None or all(exp.package is None for exp in explist):
+        return explist
+
+    definitions = {}
+    used = set(used)
+    for exp in explist:
+        if is_prunable(exp, prune) and exp.type == "expression":
+            name, names = record_definition(exp)
+            names |= expression_names(exp, latex="")
+        else:
+            name, names = None, expression_names(exp)
+        if name is None:
+            used |= names
+        else:
+            definitions.setdefault(name, []).append((exp, names))
+
+    keep = set()
+    pending = [n for n in used if n in definitions]
+    while pending:
+        name = pending.pop()
+        if name in keep:
+            continue
+        keep.add(name)
+        for _, names in definitions[name]:
+            pending.extend(n for n in names if n in definitions and n not in keep)
+    dropped = {
+        id(exp)
+        for name, defs in definitions.items()
+        if name not in keep
+        for exp, _ in defs
+    }
+    kept = [e for e in explist if id(e) not in dropped]
+    return [e for e in kept if not is_deferred(e, prune)] + [
+        e for e in kept if is_deferred(e, prune)
+    ]
+
+
+NAME_PATTERN = r"[a-zA-Z](?:_\{[a-zA-Z0-9]+\}|_[a-zA-Z0-9])?"
+# \sum_{n=t}^{t} body, which the standard library uses to map body over a list t
+MAP_SUM_RE = re.compile(
+    r"\\sum_\{(?P<var>%s)=(?P<list>%s)\}\^\{(?P=list)\}" % (NAME_PATTERN, NAME_PATTERN)
+)
+# body = a[n + offset]
+INDEX_BODY_RE = re.compile(
+    r"(?P<name>%s)\\left\[(?P<var>%s)(?P<offset>[-+].*)?\\right\]$"
+    % (NAME_PATTERN, NAME_PATTERN)
+)
+WORK_TOKEN_RE = re.compile(
+    r"\\operatorname\{[a-zA-Z]+\}|\\[a-zA-Z]+|%s|\d+|[-+*/^=<>]" % NAME_PATTERN
+)
+# list length the cost report's work estimates are for
+REPORT_LIST_LENGTH = 1000
+
+MapSumRewrite = collections.namedtuple(
+    "MapSumRewrite", "name kind before after work_before work_after"
+)
+
+
+def scan_latex(latex, start=0):
+    """Yield (index, depth) for each character of latex outside of commands.
+
+    Depth counts the \\left/\\right pairs and braces around the character.
+    """
+    depth = 0
+    i = start
+    while i < len(latex):
+        c = latex[i]
+        if c == "\\":
+            for word, step in (("\\left", 1), ("\\right", -1)):
+                if latex.startswith(word, i):
+                    i += len(word)
+                    # the delimiter, which can itself be escaped like \{
+                    i += 2 if latex.startswith("\\", i) else 1
+                    depth += step
+                    yield i - 1, depth
+                    break
+            else:
+                i += 1
+                while i < len(latex) and latex[i].isalpha():
+                    i += 1
+            continue
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        yield i, depth
+        i += 1
+
+
+def split_latex(latex, seps=","):
+    """Split latex at the characters in seps that aren't inside brackets"""
+    parts = []
+    last = 0
+    for i, depth in scan_latex(latex):
+        if depth == 0 and latex[i] in seps:
+            parts.append(latex[last:i])
+            last = i + 1
+    parts.append(latex[last:])
+    return parts
+
+
+def closing_bracket(latex, start):
+    """Return the index just past the \\right matching the \\left at start"""
+    for i, depth in scan_latex(latex, start):
+        if depth == 0:
+            return i + 1
+    return len(latex)
+
+
+def is_list_literal(latex):
+    latex = latex.strip()
+    return latex.startswith("\\left[") and closing_bracket(latex, 0) == len(latex)
+
+
+def function_calls(latex, functions):
+    """Yield (name, argument latex) for the calls in latex to functions"""
+    for m in LATEX_NAME_RE.finditer(latex):
+        name = m.group(1)
+        if name in functions and latex.startswith("\\left(", m.end()):
+            end = closing_bracket(latex, m.end())
+            inner = latex[m.end() + len("\\left(") : end - len("\\right)")]
+            yield name, split_latex(inner)
+
+
+def body_work(latex):
+    return max(len(WORK_TOKEN_RE.findall(latex)), 1)
+
+
+def list_parameters(functions, callers):
+    """Return the (function, parameter index) pairs only ever given lists.
+
+    functions maps the names to analyse to their parameters, and callers is
+    (function defined or None, latex) for everything that may call them.
+    """
+    lists = {(f, i) for f, params in functions.items() for i in range(len(params))}
+    calls = [
+        (caller, name, args)
+        for caller, latex in callers
+        for name, args in function_calls(latex, functions)
+    ]
+    changed = True
+    while changed:
+        changed = False
+        for caller, name, args in calls:
+            params = functions.get(caller, ())
+            for i in range(len(functions[name])):
+                if (name, i) not in lists:
+                    continue
+                arg = args[i].strip() if i < len(args) else ""
+                if len(args) != len(functions[name]) or not (
+                    is_list_literal(arg)
+                    or (arg in params and (caller, params.index(arg)) in lists)
+                ):
+                    lists.discard((name, i))
+                    changed = True
+    return lists
+
+
+def rewrite_map_sums(explist, used=()):
+    """Rewrite the standard library's \\sum map trick to native desmos list forms.
+
+    A function f(..., t, ...) = \\sum_{n=t}^{t} body only ever given a list t
+    evaluates body once per element of t, as a sum of its own. It becomes the
+    list comprehension [body for n=t], or the list index a[t + k] when body is
+    a[n + k]. used is names referenced from outside explist; functions in it
+    are left alone since their calls can't be checked.
+
+    Returns the new explist, with copies of the rewritten records, and a
+    MapSumRewrite for each.
+    """
+    if all(exp.package not in STANDARD_LIBRARY for exp in explist):
+        return explist, []
+    functions = {}
+    rhs = {}
+    callers = []
+    external = set(used)
+    for exp in explist:
+        if exp.package not in STANDARD_LIBRARY:
+            external |= expression_names(exp)
+            continue
+        caller = None
+        if exp.type == "expression" and exp.latex:
+            lhs, _, body = exp.latex.partition("=")
+            m = DEFINITION_RE.match(lhs)
+            if m is not None and m.group(2) is not None:
+                caller = m.group(1)
+                functions[caller] = [p.strip() for p in m.group(2).split(",")]
+                rhs[caller] = body
+        for text in (exp.latex, exp.label) + tuple((exp.slider or {}).values()):
+            if isinstance(text, str):
+                callers.append((caller, text))
+    for name in external:
+        functions.pop(name, None)
+    lists = list_parameters(functions, callers)
+
+    out = []
+    rewrites = []
+    for exp in explist:
+        name = None
+        if exp.package in STANDARD_LIBRARY and exp.latex:
+            m = DEFINITION_RE.match(exp.latex.partition("=")[0])
+            name = m.group(1) if m is not None else None
+        if name not in functions:
+            out.append(exp)
+            continue
+        m = MAP_SUM_RE.match(rhs[name])
+        params = functions[name]
+        if (
+            m is None
+            or m.group("list") not in params
+            or (name, params.index(m.group("list"))) not in lists
+        ):
+            out.append(exp)
+            continue
+        var, t = m.group("var"), m.group("list")
+        body = rhs[name][m.end() :]
+        if len(split_latex(body, ",+-=<>:")) > 1 or var in params:
+            # the sum doesn't cover the whole right hand side
+            out.append(exp)
+            continue
+
+        length = REPORT_LIST_LENGTH
+        # each of the sums accesses the list in linear time
+        work_before = length * (length + body_work(body))
+        index = INDEX_BODY_RE.match(body)
+        if (
+            index is not None
+            and index.group("var") == var
+            and index.group("name") != var
+            and var not in latex_names(index.group("offset") or "")
+        ):
+            kind = "index"
+            new_body = "%s\\left[%s%s\\right]" % (
+                index.group("name"),
+                t,
+                index.group("offset") or "",
+            )
+            work_after = length
+        else:
+            kind = "comprehension"
+            new_body = "\\left[%s\\operatorname{for}%s=%s\\right]" % (body, var, t)
+            work_after = length * body_work(body)
+
+        new = ExpressionRecord.from_dict(exp.to_dict())
+        new.package = exp.package
+        new.latex = exp.latex[: len(exp.latex) - len(rhs[name])] + new_body
+        out.append(new)
+        rewrites.append(
+            MapSumRewrite(name, kind, exp.latex, new.latex, work_before, work_after)
         )
+    return out, rewrites
+
+
+def cost_report(rewrites):
+    """Return the rewrites and their estimated work as a table"""
+    rows = [
+        f"{'function':<16} {'rewritten to':<14} {'work before':>12} {'work after':>12}"
+        f"  (for lists of {REPORT_LIST_LENGTH})"
+    ]
+    for r in rewrites:
+        rows.append(f"{r.name:<16} {r.kind:<14} {r.work_before:>12} {r.work_after:>12}")
+    return "\n".join(rows)
 
 
 class CircularDependencyError(Exception):
     pass
 
 
+def join_continuations(lines):
+    """Yield (line number, lines used, statement) for each statement in lines.
+
+    A line ending with \\ is joined with the next one, and comments are removed.
+    """
+    last = ""
+    n = 0
+    for ln, l in enumerate(lines):
+        n += 1
+        l = l.split("#")[0].strip()
+        if l.endswith("\\"):
+            last += l[:-1]
+            # print("last:", last)
+            continue
+
+        yield ln + 1, n, last + l
+
+        last = ""
+        n = 0
+    if n:
+        # file ended in a continuation
+        yield ln + 1, n, last
+
+
+# A statement of an incrementally parsed graph: the number of source lines it
+#  spans, the graph's (color, folder, viewport) before it, the number of
+#  expressions it added and whether it changed the last one before it.
+SourceStatement = collections.namedtuple(
+    "SourceStatement", ["nlines", "state", "count", "modifies_last"]
+)
+
+# Expressions added and changed by DesmosScript.apply_edit, in graph order, and
+#  the ids of the removed ones
+EditDiff = collections.namedtuple("EditDiff", ["added", "changed", "removed"])
+
+
 class DesmosScript:
     STATEMENTS = [
         Comment,
@@ -429,7 +1363,67 @@ class DesmosScript:
         Expression,
     ]
 
-    def __init__(self, randseed=None, callstack=[], name="<root>"):
+    @classmethod
+    def register_statement(cls, statement, before=None):
+        """Add a statement to this class's parser, ahead of before (Expression by default)"""
+        statements = list(cls.STATEMENTS)
+        statements.insert(statements.index(before or Expression), statement)
+        cls.STATEMENTS = statements
+
+    @classmethod
+    def get_dispatch(cls):
+        """Return a mapping of first character to the statements to try for a line
+
+        Lines whose first character isn't in the mapping only try the statements
+        without prefixes. The table is rebuilt whenever STATEMENTS changes, by
+        being replaced or modified in place.
+        """
+        cached = cls.__dict__.get("_dispatch")
+        # compared with a copy, so changes to the list itself are seen too
+        if cached is not None and cached[0] == cls.STATEMENTS:
+            return cached[1]
+
+        # statements without a (non-empty) prefix have to be tried on every line
+        catch_all = [
+            s for s in cls.STATEMENTS if not s.get_prefixes() or "" in s.get_prefixes()
+        ]
+        table = {}
+        for s in cls.STATEMENTS:
+            if s not in catch_all:
+                for p in s.get_prefixes():
+                    table.setdefault(p[0], set()).add(s)
+        for c, statements in table.items():
+            table[c] = tuple(
+                s for s in cls.STATEMENTS if s in statements or s in catch_all
+            )
+        fallback = tuple(catch_all)
+        cls._dispatch = (cls.STATEMENTS[:], (table, fallback))
+        return table, fallback
+
+    def __init__(
+        self,
+        randseed=None,
+        callstack=[],
+        name="<root>",
+        build_cache=None,
+        profile=False,
+        incremental=False,
+        prune="stdlib",
+        optimize=True,
+        jobs=None,
+        diagnostics=None,
+    ):
+        """profile is True or a Profiler to share, recording where parsing takes time.
+
+        An incremental graph keeps its source and the state at each statement,
+        so parse sets its source and apply_edit can be used to change it.
+        prune is passed to prune_unused when the graph is output, and with
+        optimize the output goes through rewrite_map_sums.
+        With jobs above 1, expressions are converted to latex on that many worker
+        processes, after the lines around them have been parsed.
+        diagnostics is the Diagnostics to collect warnings in, shared with included
+        packages. Without one, the graph reports its own to stderr after parsing.
+        """
         if randseed is None:
             randseed = "%030x" % random.randrange(16 ** 32)
         self.randseed = randseed
@@ -440,15 +1434,48 @@ class DesmosScript:
         self.folder = None
         self.viewport = {"xmin": -10, "ymin": -10, "xmax": 10, "ymax": 10}
         self.callstack = callstack + [(name, None)]
+        # .dscript files included by this graph, directly or through other includes
+        self.includes = set()
+        self.build_cache = build_cache
+        self.profiler = Profiler() if profile is True else profile or None
+        self.incremental = incremental
+        self.prune = prune
+        self.optimize = optimize
+        # MapSumRewrites made the last time the graph was output
+        self.rewrites = []
+        # source lines and their SourceStatements when incremental
+        self.lines = []
+        self.statements = []
+        # ids to give reparsed expressions, so they keep theirs
+        self.reuse_ids = collections.deque()
+        self.report_warnings = diagnostics is None
+        self.diagnostics = Diagnostics() if diagnostics is None else diagnostics
+        self.jobs = jobs
+        self.pool = None
+        # expressions waiting to be converted, as (records, lines, line numbers),
+        #  and the chunks of them being converted, with their futures
+        self.pending = ([], [], [])
+        self.converting = collections.deque()
 
     def add_exp(self, data):
-        self.exp_id += 1
-        data["id"] = str(self.exp_id)
+        if isinstance(data, dict):
+            data = ExpressionRecord.from_dict(data)
+        if self.reuse_ids:
+            data.id = self.reuse_ids.popleft()
+        else:
+            self.exp_id += 1
+            data.id = str(self.exp_id)
         # print("Adding exp:", data)
         self.explist.append(data)
 
-    def warn(self, *msgs):
-        print("WARN:", *msgs, "\n" + self.get_trace(), file=sys.stderr)
+    def warn(self, *msgs, code="warning"):
+        trace = tuple(self.callstack[:-1]) + ((self.callstack[-1][0], self.lineno),)
+        self.diagnostics.add(code, " ".join(map(str, msgs)), trace)
+
+    def report(self):
+        """Write the warnings collected so far to stderr, if the graph owns them"""
+        if self.report_warnings:
+            self.diagnostics.report()
 
     def parse_line(self, l):
         l = l.strip()
@@ -456,27 +1483,236 @@ class DesmosScript:
             return
         # print("parsing", l)
 
-        for s in self.STATEMENTS:
+        table, fallback = self.get_dispatch()
+        statements = table.get(l[0], fallback)
+        if self.profiler is not None:
+            return self.profile_line(statements, l)
+        for s in statements:
             r = s.parse(self, l)
             if r:
-                break
+                return s
+
+    def profile_line(self, statements, l):
+        start = time.perf_counter()
+        try:
+            for s in statements:
+                if self.profiler.call(s.__name__, s.parse, self, l):
+                    return s
+        finally:
+            self.update_callstack()
+            name, line = self.callstack[-1]
+            self.profiler.add_line(f"{name}:{line}", time.perf_counter() - start, l)
+
+    def timed(self, name, fn, *args):
+        """Call fn with args, timing it under name when profiling"""
+        if self.profiler is None:
+            return fn(*args)
+        return self.profiler.call(name, fn, *args)
+
+    def defer_expression(self, exp, l):
+        """Convert l to exp's latex later, in a worker process"""
+        records, lines, linenos = self.pending
+        records.append(exp)
+        lines.append(l)
+        linenos.append(self.lineno)
+        if len(lines) >= CONVERT_CHUNK:
+            self.submit_pending()
+
+    def submit_pending(self):
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        records, lines, linenos = self.pending
+        future = self.pool.submit(convert_expressions, lines)
+        self.converting.append((records, lines, linenos, future))
+        self.pending = ([], [], [])
+
+    def collect_conversions(self, wait=False):
+        """Set the latex of converted chunks, in order, until one isn't done"""
+        while self.converting and (wait or self.converting[0][3].done()):
+            records, lines, linenos, future = self.converting.popleft()
+            try:
+                latex = self.timed("convert_expressions", future.result)
+            except Exception:
+                # convert again here, so an error is raised at its line
+                latex = self.convert_here(lines, linenos)
+            for exp, s in zip(records, latex):
+                exp.latex = s
+
+    def convert_here(self, lines, linenos):
+        lineno = self.lineno
+        latex = []
+        for l, self.lineno in zip(lines, linenos):
+            l = self.timed("replace_ifs", replace_ifs, l)
+            latex.append(self.timed("convert_to_latex", convert_to_latex, l))
+        self.lineno = lineno
+        return latex
+
+    def convert_pending(self):
+        """Finish converting deferred expressions, stopping the worker processes"""
+        records, lines, linenos = self.pending
+        if lines and self.pool is None and len(lines) < CONVERT_CHUNK:
+            # not worth starting processes for
+            for exp, s in zip(records, self.convert_here(lines, linenos)):
+                exp.latex = s
+            self.pending = ([], [], [])
+        elif lines:
+            self.submit_pending()
+        try:
+            self.collect_conversions(wait=True)
+        finally:
+            self.stop_workers()
+
+    def stop_workers(self):
+        """Drop any expressions not converted yet and shut down the workers"""
+        self.pending = ([], [], [])
+        self.converting.clear()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
 
     def parse(self, data):
         # Make line extensions be on the same line
         # data = re.sub(r'\\(?: +)?\n(?: +)?', '', data)
+        if self.incremental:
+            self.apply_edit(0, len(self.lines), data)
+        else:
+            self.parse_stream(data.split("\n"))
 
-        last = ""
-        for ln, l in enumerate(data.split("\n")):
-            self.lineno = ln + 1
-            l = l.split("#")[0].strip()
-            if l.endswith("\\"):
-                last += l[:-1]
-                # print("last:", last)
-                continue
-
-            self.parse_line(last + l)
+    def parse_stream(self, lines):
+        """Parse source from an iterable of lines, such as an open file.
 
-            last = ""
+        A line ending with \\ is joined with the next one, so only the statement
+        currently being parsed is held in memory.
+        """
+        try:
+            for lineno, _, l in join_continuations(lines):
+                self.lineno = lineno
+                self.parse_line(l)
+        except BaseException:
+            self.stop_workers()
+            raise
+        finally:
+            self.report()
+        self.convert_pending()
+
+    def parse_statements(self, lines, first_line=0):
+        """Parse lines, returning a SourceStatement for each statement in them"""
+        statements = []
+        for lineno, n, l in join_continuations(lines):
+            self.lineno = first_line + lineno
+            state = (self.color, self.folder, self.viewport)
+            count = len(self.explist)
+            s = self.parse_line(l)
+            statements.append(
+                SourceStatement(
+                    n,
+                    state,
+                    len(self.explist) - count,
+                    s is not None and s.MODIFIES_LAST,
+                )
+            )
+        return statements
+
+    def apply_edit(self, start_line, end_line, new_text):
+        """Replace source lines start_line to end_line (0 based, exclusive) with new_text.
+
+        new_text is the replacement lines, joined with newlines or as a list ([]
+        deletes the lines).
+        Only the statements the edit touches are parsed again, along with those
+        after it until the graph's state is the same as before the edit.
+        Reparsed expressions keep their ids where they can. Returns an EditDiff.
+        """
+        if not self.incremental:
+            raise ValueError("apply_edit needs a graph created with incremental=True")
+        statements = self.statements
+        starts = [0]
+        for st in statements:
+            starts.append(starts[-1] + st.nlines)
+
+        # the statement the edit starts in
+        a = 0
+        while a < len(statements) and starts[a + 1] <= start_line:
+            a += 1
+        # the edit could add a statement changing the last expression before it,
+        #  so the statement adding that is reparsed too, with anything changing it
+        if a:
+            a -= 1
+            while a and (statements[a].modifies_last or not statements[a].count):
+                a -= 1
+        b = a
+        while b < len(statements) and starts[b] < max(end_line, start_line + 1):
+            b += 1
+        lines = (
+            self.lines[starts[a] : start_line]
+            + (new_text.split("\n") if isinstance(new_text, str) else list(new_text))
+            + self.lines[end_line : starts[b]]
+        )
+        # a continuation at the end joins the next statement to the edit
+        while (
+            b < len(statements)
+            and lines
+            and lines[-1].split("#")[0].strip().endswith("\\")
+        ):
+            lines += self.lines[starts[b] : starts[b + 1]]
+            b += 1
+
+        explist = self.explist
+        offset = sum(st.count for st in statements[:a])
+        old = explist[offset : offset + sum(st.count for st in statements[a:b])]
+        final_state = (self.color, self.folder, self.viewport)
+        if a < len(statements):
+            self.color, self.folder, self.viewport = statements[a].state
+        self.explist = []
+        self.reuse_ids.extend(e.id for e in old)
+        try:
+            new_statements = self.parse_statements(lines, starts[a])
+            # continue until the state is the same as it was before the edit, and
+            #  the next statement adds an expression rather than changing the last
+            while b < len(statements) and (
+                statements[b].modifies_last
+                or not statements[b].count
+                or statements[b].state != (self.color, self.folder, self.viewport)
+            ):
+                st_old = explist[
+                    offset + len(old) : offset + len(old) + statements[b].count
+                ]
+                self.reuse_ids.clear()
+                self.reuse_ids.extend(e.id for e in st_old)
+                st_lines = self.lines[starts[b] : starts[b + 1]]
+                new_statements += self.parse_statements(
+                    st_lines, starts[a] + len(lines)
+                )
+                old += st_old
+                lines += st_lines
+                b += 1
+            self.convert_pending()
+        except BaseException:
+            self.stop_workers()
+            self.color, self.folder, self.viewport = final_state
+            self.explist = explist
+            raise
+        finally:
+            self.reuse_ids.clear()
+            self.report()
+        if b < len(statements):
+            self.color, self.folder, self.viewport = final_state
+
+        new = self.explist
+        explist[offset : offset + len(old)] = new
+        self.explist = explist
+        self.lines[starts[a] : starts[b]] = lines
+        statements[a:b] = new_statements
+
+        old_by_id = {e.id: e for e in old}
+        added = []
+        changed = []
+        for e in new:
+            prev = old_by_id.pop(e.id, None)
+            if prev is None:
+                added.append(e)
+            elif prev.to_json() != e.to_json():
+                changed.append(e)
+        return EditDiff(added, changed, list(old_by_id))
 
     def update_callstack(self):
         """Update the last frame of the traceback's (the current one) to have to current line number. """
@@ -484,64 +1720,270 @@ class DesmosScript:
 
     def get_trace(self):
         self.update_callstack()
-        lines = []
-        for f, line in reversed(self.callstack):
-            l = f"    file {f}"
-
-            if line is not None:
-                l += f" line {line}"
-            lines.append(l)
-        return "\n".join(lines)
+        return format_trace(self.callstack)
 
-    def make_child_graph(self, name):
+    def check_circular(self, name):
         if name in set([i[0] for i in self.callstack]):
             raise CircularDependencyError(
                 f"Attempt to import from {name!r} when it is in the call stack\n{self.get_trace()}"
             )
+
+    def make_child_graph(self, name):
+        self.check_circular(name)
         self.update_callstack()
         return DesmosScript(
-            randseed=self.randseed, callstack=self.callstack.copy(), name=name
+            randseed=self.randseed,
+            callstack=self.callstack.copy(),
+            name=name,
+            build_cache=self.build_cache,
+            profile=self.profiler,
+            diagnostics=self.diagnostics,
         )
 
     def get_latex_statements(self):
         return [i["latex"] for i in self.explist if i["type"] == "expression"]
 
+    def output_explist(self):
+        """The expressions to output, without definitions removed by prune"""
+        explist = prune_unused(self.explist, self.prune)
+        if self.optimize:
+            explist, self.rewrites = rewrite_map_sums(explist)
+        return explist
+
     def json(self):
         return {
             "version": 7,
             "graph": {"viewport": self.viewport},
             "randomSeed": self.randseed,
-            "expressions": {"list": self.explist},
+            "expressions": {"list": [e.to_dict() for e in self.output_explist()]},
+        }
+
+    def dump(self, fp):
+        """Write the graph's calc_state to fp as compact json with sorted keys"""
+        fp.write(serialize.STATE_START)
+        for i, exp in enumerate(self.output_explist()):
+            fp.write("," if i else "")
+            fp.write(exp.to_json())
+        fp.write(serialize.state_end(self.viewport, self.randseed))
+
+    def encode(self):
+        """Return a serialize.EncodedState of the calc_state, for DesmosClient"""
+        expressions = [(e.id, e.to_json()) for e in self.output_explist()]
+        calc_state = (
+            serialize.STATE_START
+            + ",".join([j for _, j in expressions])
+            + serialize.state_end(self.viewport, self.randseed)
+        )
+        other = {
+            "graph": {"viewport": self.viewport},
+            "randomSeed": self.randseed,
+            "version": 7,
         }
+        return serialize.EncodedState(calc_state, expressions, other)
+
+    def dumps(self):
+        """Return the calc_state as json, identical to serialize.dumps(self.json())"""
+        return (
+            serialize.STATE_START
+            + ",".join([e.to_json() for e in self.output_explist()])
+            + serialize.state_end(self.viewport, self.randseed)
+        )
 
 
-def desmos_compile(data, randseed=None):
-    g = DesmosScript(randseed=randseed)
+def desmos_compile(data, randseed=None, prune="stdlib", optimize=True):
+    g = DesmosScript(randseed=randseed, prune=prune, optimize=optimize)
     g.parse(data)
     return g.json()
 
 
-def compile_file(inf, outf, write_tex=False, randseed=None):
+def compile_stream(
+    infile,
+    outfile,
+    texfile=None,
+    randseed=None,
+    name="<stream>",
+    build_cache=None,
+    profile=False,
+    prune="stdlib",
+    optimize=True,
+    jobs=None,
+    diagnostics=None,
+):
+    """Compile lines from infile, writing the graph json to outfile as it is parsed.
+
+    Expressions are written out as soon as the next one is added (statements like
+    slider only modify the last expression), so memory use doesn't grow with the
+    size of the graph. The viewport is written last since bounds can appear
+    anywhere in the script. Returns the graph, which only holds its state.
+
+    Definitions that prune could remove wait until the end, since a later line
+    may use them, and are written after the rest as prune_unused orders them.
+    Those inside a folder keep their place, so everything after them waits too,
+    and so does the standard library with optimize but without prune, for
+    rewrite_map_sums. With jobs, expressions wait until their chunk has been
+    converted.
+    The output is the same as DesmosScript.dumps, so it can be uploaded as is.
+    """
+    g = DesmosScript(
+        randseed=randseed,
+        name=name,
+        build_cache=build_cache,
+        profile=profile,
+        prune=prune,
+        optimize=optimize,
+        jobs=jobs,
+        diagnostics=diagnostics,
+    )
+    outfile.write(serialize.STATE_START)
+    written = tex_written = 0
+    # names used by the expressions already written
+    used = set()
+    # definitions prune could remove, taken out of g.explist in order
+    deferred = []
+
+    def flush(keep):
+        done = len(g.explist) - keep
+        ready = []
+        for i in range(max(done, 0)):
+            exp = g.explist[i]
+            if exp.latex is None and exp.type == "expression":
+                # still being converted
+                done = i
+                break
+            if is_deferred(exp, prune):
+                deferred.append(exp)
+            elif is_prunable(exp, prune) or (
+                optimize and exp.package in STANDARD_LIBRARY
+            ):
+                done = i
+                break
+            else:
+                ready.append(exp)
+        if done <= 0:
+            return
+        write(ready)
+        del g.explist[:done]
+
+    def write(explist):
+        nonlocal written, tex_written
+        for exp in explist:
+            if prune is not None or optimize:
+                used.update(expression_names(exp))
+            outfile.write("," if written else "")
+            outfile.write(exp.to_json())
+            if texfile is not None and exp["type"] == "expression":
+                texfile.write("\n" if tex_written else "")
+                texfile.write(exp["latex"])
+                tex_written += 1
+            written += 1
+
+    def lines():
+        for l in infile:
+            yield l
+            # the previous line has been parsed when the next one is requested
+            g.collect_conversions()
+            flush(1)
+
+    g.parse_stream(lines())
+    explist = prune_unused(deferred + g.explist, prune, used)
+    if optimize:
+        explist, g.rewrites = rewrite_map_sums(explist, used)
+    write(explist)
+    g.explist.clear()
+    outfile.write(serialize.state_end(g.viewport, g.randseed))
+    return g
+
+
+def pack_file(inf, outf=None):
+    """Compile the package inf to a .dlib file, outf by default inf with .dlib"""
+    if outf is None:
+        outf = os.path.splitext(inf)[0] + dlib.EXT
+    g = DesmosScript(name=inf)
     with open(inf, "r") as f:
-        data = f.read()
-    g = DesmosScript(randseed=randseed, name=inf)
-    g.parse(data)
-    out = g.json()
-
-    with open(outf, "w+") as f:
-        f.write(json.dumps(out))
-
-    with open(outf + ".tex", "w+") as f:
-        f.write("\n".join(g.get_latex_statements()))
-
-
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <infile> [outfile]")
-    inf = sys.argv[1]
-    if len(sys.argv) > 2:
-        out = sys.argv[2]
-    else:
-        parts = inf.split(".")
-        out = ".".join(parts[:-1] if len(parts) > 1 else parts) + ".djson"
-    compile_file(inf, outf)
+        g.parse_stream(f)
+    statements = g.get_latex_statements()
+    header = {
+        "source": inf,
+        "includes": {n: hash_file(n) for n in sorted(g.includes | {inf})},
+        "exports": [],
+    }
+    for s in statements:
+        name, names = latex_definition(s)
+        header["exports"].append([name, sorted(names)])
+    dlib.write_dlib(outf, header, statements)
+    return outf
+
+
+def compile_file(
+    inf,
+    outf,
+    write_tex=False,
+    randseed=None,
+    build_cache=None,
+    profile=False,
+    prune="stdlib",
+    optimize=True,
+    jobs=None,
+    diagnostics=None,
+):
+    """Compile inf to outf and its latex to outf.tex, reusing build_cache if given
+
+    profile, prune, optimize, jobs and diagnostics are passed to DesmosScript.
+    Returns the graph, or None when the cache was used, in which case nothing is
+    profiled.
+    """
+    # without diagnostics, warnings are reported here, even on a cache hit
+    own = diagnostics is None
+    if own:
+        diagnostics = Diagnostics()
+    # kept apart from the entries of the same file as an include
+    options = {"prune": prune, "optimize": optimize}
+    try:
+        if build_cache is not None:
+            meta = build_cache.load(inf, randseed=randseed, options=options)
+            if meta is not None:
+                build_cache.copy_outputs(inf, outf, options)
+                diagnostics.replay(meta.get("warnings", []))
+                return None
+            source_hash = hash_file(inf)
+
+        # written to temporary files so a failed compile doesn't leave partial output
+        try:
+            with diagnostics.recording() as raised, open(inf, "r") as f:
+                with open(outf + ".tmp", "w+") as out:
+                    with open(outf + ".tex.tmp", "w+") as tex:
+                        g = compile_stream(
+                            f,
+                            out,
+                            texfile=tex,
+                            randseed=randseed,
+                            name=inf,
+                            build_cache=build_cache,
+                            profile=profile,
+                            prune=prune,
+                            optimize=optimize,
+                            jobs=jobs,
+                            diagnostics=diagnostics,
+                        )
+        except BaseException:
+            for path in (outf + ".tmp", outf + ".tex.tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        os.replace(outf + ".tmp", outf)
+        os.replace(outf + ".tex.tmp", outf + ".tex")
+
+        if build_cache is not None:
+            build_cache.store(
+                inf,
+                source_hash,
+                g.includes,
+                outf=outf,
+                randseed=g.randseed,
+                options=options,
+                warnings=to_json_records(raised),
+            )
+        return g
+    finally:
+        if own:
+            diagnostics.report()
@@ -0,0 +1,257 @@
+"""Command line entry point.
+
+python -m dscript <infile> [outfile]
+python -m dscript build <glob>...
+python -m dscript pack <glob>...
+python -m dscript check <glob>...
+"""
+
+import argparse
+import json
+import sys
+
+from . import cache_stats, compile_file, cost_report, desmos_compile, pack_file
+from .build import build, default_outfile, expand_patterns
+from .buildcache import CACHE_DIR, BuildCache
+from .diagnostics import Diagnostics
+from .profiling import Profiler
+
+
+def add_common_args(parser):
+    parser.add_argument("--randseed", help="random seed to put in the graph")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="compile without the build cache"
+    )
+    parser.add_argument(
+        "--clear-cache", action="store_true", help="delete the build cache first"
+    )
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    prune = parser.add_mutually_exclusive_group()
+    prune.add_argument(
+        "--keep-unused",
+        dest="prune",
+        action="store_const",
+        const=None,
+        default="stdlib",
+        help="keep standard library definitions the script doesn't use",
+    )
+    prune.add_argument(
+        "--prune-includes",
+        dest="prune",
+        action="store_const",
+        const="all",
+        help="also remove unused definitions from included files",
+    )
+    parser.add_argument(
+        "--no-optimize",
+        dest="optimize",
+        action="store_false",
+        help="keep the standard library's list helpers as they are written",
+    )
+    parser.add_argument(
+        "--max-warnings",
+        type=int,
+        metavar="N",
+        help="show at most N warnings of each kind, counting the rest",
+    )
+    parser.add_argument(
+        "--dedupe-warnings",
+        action="store_true",
+        help="show repeated warnings once, with how many times they were raised",
+    )
+
+
+def get_cache(args):
+    cache = BuildCache(args.cache_dir)
+    if args.clear_cache:
+        cache.clear()
+    return None if args.no_cache else cache
+
+
+def main_build(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m dscript build",
+        description="Compile many DesmosScript files in parallel",
+    )
+    parser.add_argument("patterns", nargs="+", metavar="glob")
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="worker processes (default: cpu count)"
+    )
+    add_common_args(parser)
+    args = parser.parse_args(argv)
+
+    return build(
+        args.patterns,
+        max_workers=args.jobs,
+        randseed=args.randseed,
+        build_cache=get_cache(args),
+        prune=args.prune,
+        optimize=args.optimize,
+        max_warnings=args.max_warnings,
+        dedupe_warnings=args.dedupe_warnings,
+    )
+
+
+def main_pack(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m dscript pack",
+        description="Precompile DesmosScript packages to .dlib files next to them",
+    )
+    parser.add_argument("patterns", nargs="+", metavar="glob")
+    args = parser.parse_args(argv)
+
+    for f in expand_patterns(args.patterns):
+        print(f"Packed {f} to {pack_file(f)}")
+    return 0
+
+
+def main_check(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m dscript check",
+        description="Evaluate compiled graphs offline to find broken expressions",
+    )
+    parser.add_argument(
+        "patterns", nargs="+", metavar="glob", help=".dscript or .djson"
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=3,
+        help="slider positions to evaluate at, besides their values (default: 3)",
+    )
+    parser.add_argument(
+        "--max-work", type=int, help="values an expression may compute (default: 1e6)"
+    )
+    parser.add_argument(
+        "--costs", action="store_true", help="print every expression's cost"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the reports as json")
+    args = parser.parse_args(argv)
+
+    from . import evaluate
+
+    if evaluate.np is None:
+        print("check needs numpy: pip install numpy", file=sys.stderr)
+        return 2
+    kwargs = {"samples": args.samples}
+    if args.max_work:
+        kwargs["max_work"] = args.max_work
+    status = 0
+    output = {}
+    for f in expand_patterns(args.patterns):
+        with open(f, "r") as fp:
+            if f.endswith(".djson"):
+                state = json.load(fp)
+            else:
+                state = desmos_compile(fp.read(), randseed="0")
+        reports = evaluate.evaluate_state(state, **kwargs)
+        output[f] = [r._asdict() for r in reports]
+        failed = [r for r in reports if r.status != "ok"]
+        for r in reports if args.costs else failed:
+            print(
+                f"{f}:{r.index}: {r.status}: "
+                f"{r.error or ''}{' ' if r.error else ''}[work {r.work}, "
+                f"longest list {r.max_list}, sum depth {r.sum_depth}]\n"
+                f"    {r.latex[:100]}"
+            )
+        print(f"Checked {f}: {len(reports)} expressions, {len(failed)} failed")
+        if failed:
+            status = 1
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(output, fp, indent=2)
+    return status
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["build"]:
+        return main_build(argv[1:])
+    if argv[:1] == ["pack"]:
+        return main_pack(argv[1:])
+    if argv[:1] == ["check"]:
+        return main_check(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        prog="python -m dscript", description="Compile DesmosScript to desmos json"
+    )
+    parser.add_argument("infile", nargs="?")
+    parser.add_argument("outfile", nargs="?")
+    add_common_args(parser)
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where compiling took time (implies --no-cache)",
+    )
+    parser.add_argument(
+        "--profile-json", metavar="FILE", help="also write the profile as json"
+    )
+    parser.add_argument(
+        "--warnings-json", metavar="FILE", help="write the warnings as json instead"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="worker processes to convert expressions on (default: 1)",
+    )
+    parser.add_argument(
+        "--cost-report",
+        action="store_true",
+        help="print the list helpers optimized and their estimated work "
+        "(implies --no-cache)",
+    )
+    args = parser.parse_args(argv)
+
+    cache = get_cache(args)
+    if args.infile is None:
+        if not args.clear_cache:
+            parser.print_usage()
+        return 0
+
+    profiler = None
+    if args.profile or args.profile_json:
+        profiler = Profiler()
+        cache = None
+    if args.cost_report:
+        cache = None
+    diagnostics = Diagnostics(args.max_warnings, args.dedupe_warnings)
+    try:
+        g = compile_file(
+            args.infile,
+            args.outfile or default_outfile(args.infile),
+            randseed=args.randseed,
+            build_cache=cache,
+            profile=profiler,
+            prune=args.prune,
+            optimize=args.optimize,
+            jobs=args.jobs,
+            diagnostics=diagnostics,
+        )
+    finally:
+        if args.warnings_json:
+            with open(args.warnings_json, "w") as f:
+                diagnostics.dump(f)
+        else:
+            diagnostics.report()
+    if args.cost_report:
+        print(cost_report(g.rewrites), file=sys.stderr)
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+        for name, stats in cache_stats().items():
+            print(
+                f"{name} cache: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['size']}/{stats['maxsize']} entries",
+                file=sys.stderr,
+            )
+    if args.profile_json:
+        data = profiler.to_json()
+        data["caches"] = cache_stats()
+        with open(args.profile_json, "w") as f:
+            json.dump(data, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Compile many .dscript files in parallel"""
+import concurrent.futures
+import contextlib
+import glob
+import io
+import random
+import sys
+import traceback
+
+from . import compile_file
+from .diagnostics import Diagnostics
+
+
+def default_outfile(inf):
+    parts = inf.split(".")
+    return ".".join(parts[:-1] if len(parts) > 1 else parts) + ".djson"
+
+
+def expand_patterns(patterns):
+    """Return the files matching patterns, in order and without duplicates"""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        for f in matches or [pattern]:
+            if f not in files:
+                files.append(f)
+    return files
+
+
+def compile_one(
+    inf,
+    randseed=None,
+    build_cache=None,
+    prune="stdlib",
+    optimize=True,
+    max_warnings=None,
+    dedupe_warnings=False,
+):
+    """Compile inf, returning its warnings and the traceback if it failed"""
+    if randseed is None:
+        # forked workers all start with the parent's random state
+        random.seed()
+    out = io.StringIO()
+    error = None
+    diagnostics = Diagnostics(max_warnings, dedupe_warnings)
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            compile_file(
+                inf,
+                default_outfile(inf),
+                randseed=randseed,
+                build_cache=build_cache,
+                prune=prune,
+                optimize=optimize,
+                diagnostics=diagnostics,
+            )
+        except Exception:
+            error = traceback.format_exc()
+    diagnostics.report(out)
+    return out.getvalue(), error
+
+
+def build(
+    patterns,
+    max_workers=None,
+    randseed=None,
+    build_cache=None,
+    prune="stdlib",
+    optimize=True,
+    max_warnings=None,
+    dedupe_warnings=False,
+):
+    """Compile every file matching patterns in a process pool.
+
+    Each file's warnings are printed together, in input order. Returns the exit
+    status, which is 1 if any file failed to compile.
+    """
+    files = expand_patterns(patterns)
+    if not files:
+        print("No files to compile", file=sys.stderr)
+        return 1
+
+    status = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        futures = [
+            pool.submit(
+                compile_one,
+                f,
+                randseed,
+                build_cache,
+                prune,
+                optimize,
+                max_warnings,
+                dedupe_warnings,
+            )
+            for f in files
+        ]
+        for f, future in zip(files, futures):
+            output, error = future.result()
+            if output:
+                sys.stderr.write(output)
+            if error:
+                print(f"ERROR: Unable to compile {f}\n{error}", file=sys.stderr)
+                status = 1
+            else:
+                print(f"Compiled {f}")
+    return status
@@ -0,0 +1,129 @@
+"""On-disk cache of compiled .dscript files"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+
+CACHE_DIR = ".dscript-cache"
+
+_compiler_version = None
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compiler_version():
+    """Hash of the compiler's source, so entries are dropped when it changes"""
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        pattern = os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py")
+        for path in sorted(glob.glob(pattern)):
+            h.update(hash_file(path).encode())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+
+class BuildCache:
+    """Compiled output of .dscript files, stored under directory.
+
+    Each entry holds the source's content hash, the hashes of every file it
+    includes (directly or not) and the compiler version, along with the latex
+    statements and, for files compiled with compile_file, the graph json. The
+    warnings raised compiling it are kept too, to be replayed when it is used.
+    Sources compiled with different options (a dict) have separate entries.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def entry_path(self, source, ext, options=None):
+        key = os.path.realpath(source)
+        if options:
+            key += "\0" + json.dumps(options, sort_keys=True)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, name + ext)
+
+    def load(self, source, randseed=None, options=None):
+        """Return the entry for source if neither it nor its includes changed"""
+        try:
+            with open(self.entry_path(source, ".json", options), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != compiler_version():
+            return None
+        if randseed is not None and meta.get("randseed") != randseed:
+            return None
+        for path, digest in [(source, meta["hash"])] + list(meta["includes"].items()):
+            try:
+                if hash_file(path) != digest:
+                    return None
+            except OSError:
+                return None
+        return meta
+
+    def read_statements(self, source):
+        with open(self.entry_path(source, ".tex"), "r") as f:
+            data = f.read()
+        return data.split("\n") if data else []
+
+    def copy_outputs(self, source, outf, options=None):
+        """Copy the cached graph json and latex of source to outf and outf.tex"""
+        shutil.copyfile(self.entry_path(source, ".djson", options), outf)
+        shutil.copyfile(self.entry_path(source, ".tex", options), outf + ".tex")
+
+    def store(
+        self,
+        source,
+        source_hash,
+        includes,
+        statements=None,
+        outf=None,
+        randseed=None,
+        options=None,
+        warnings=(),
+    ):
+        """Add an entry for source, from its latex statements or compiled outf
+
+        warnings are from diagnostics.to_json_records.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {
+            "version": compiler_version(),
+            "source": source,
+            "hash": source_hash,
+            "includes": {n: hash_file(n) for n in sorted(includes)},
+            "randseed": randseed,
+            "warnings": list(warnings),
+        }
+        # files are replaced whole since other processes may be reading them
+        tmp = ".%d.tmp" % os.getpid()
+        if outf is not None:
+            path = self.entry_path(source, ".djson", options)
+            shutil.copyfile(outf, path + tmp)
+            os.replace(path + tmp, path)
+            path = self.entry_path(source, ".tex", options)
+            shutil.copyfile(outf + ".tex", path + tmp)
+            os.replace(path + tmp, path)
+        else:
+            path = self.entry_path(source, ".tex", options)
+            with open(path + tmp, "w") as f:
+                f.write("\n".join(statements))
+            os.replace(path + tmp, path)
+
+        # the metadata is written last so a partial entry is never loaded
+        path = self.entry_path(source, ".json", options)
+        with open(path + tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(path + tmp, path)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
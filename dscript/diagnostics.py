@@ -0,0 +1,138 @@
+"""Warnings collected while compiling, reported together when it is done"""
+import collections
+import contextlib
+import json
+import sys
+
+# A warning: a short code naming its kind, the file and line it was raised at,
+#  the message and the callstack of (file, line) frames, innermost last
+Diagnostic = collections.namedtuple(
+    "Diagnostic", ["code", "file", "line", "message", "trace"]
+)
+
+
+def format_trace(trace):
+    lines = []
+    for f, line in reversed(trace):
+        l = f"    file {f}"
+        if line is not None:
+            l += f" line {line}"
+        lines.append(l)
+    return "\n".join(lines)
+
+
+def to_json_records(raised, depth=0):
+    """raised as json, for replay, leaving out the first depth frames of each trace"""
+    return [[d.code, d.message, [list(f) for f in d.trace[depth:]]] for d in raised]
+
+
+class Diagnostics:
+    """Warnings of a graph and the packages it includes, kept as Diagnostic records.
+
+    With dedupe, a warning with the same code and message as an earlier one is
+    only counted. max_per_code caps the warnings kept of each code, the rest are
+    only counted. Their text is only built when they are reported.
+    """
+
+    def __init__(self, max_per_code=None, dedupe=False):
+        self.max_per_code = max_per_code
+        self.dedupe = dedupe
+        self.records = []
+        # times each record was raised, by index, when more than once
+        self.repeats = {}
+        # record index by (code, message) when deduplicating
+        self.seen = {}
+        self.kept = collections.Counter()
+        self.suppressed = collections.Counter()
+        # lists of the warnings raised inside each recording block
+        self.recorders = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, code, message, trace):
+        """Record a warning, trace being the callstack it was raised from"""
+        f, line = trace[-1]
+        d = Diagnostic(code, f, line, message, trace)
+        for raised in self.recorders:
+            raised.append(d)
+        if self.dedupe:
+            i = self.seen.get((code, message))
+            if i is not None:
+                self.repeats[i] = self.repeats.get(i, 1) + 1
+                return
+        if self.max_per_code is not None and self.kept[code] >= self.max_per_code:
+            self.suppressed[code] += 1
+            return
+        self.kept[code] += 1
+        if self.dedupe:
+            self.seen[(code, message)] = len(self.records)
+        self.records.append(d)
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Collect every warning added in the with block in a list.
+
+        Warnings the dedupe or cap leave out are collected too, so a cached
+        compile can replay them all.
+        """
+        raised = []
+        self.recorders.append(raised)
+        try:
+            yield raised
+        finally:
+            # by identity: a nested recording's list can equal the outer one
+            popped = self.recorders.pop()
+            assert popped is raised, "recordings must be nested"
+
+    def replay(self, records, frames=()):
+        """Add warnings from to_json_records, their traces under frames"""
+        frames = tuple(tuple(f) for f in frames)
+        for code, message, trace in records:
+            self.add(code, message, frames + tuple(tuple(f) for f in trace))
+
+    def clear(self):
+        self.records.clear()
+        self.repeats.clear()
+        self.seen.clear()
+        self.kept.clear()
+        self.suppressed.clear()
+
+    def format_text(self):
+        out = []
+        for i, d in enumerate(self.records):
+            repeats = self.repeats.get(i)
+            more = f" (repeated {repeats} times)" if repeats else ""
+            out.append(f"WARN: {d.message}{more}\n{format_trace(d.trace)}\n")
+        for code, n in sorted(self.suppressed.items()):
+            out.append(f"WARN: {n} more {code!r} warnings not shown\n")
+        return "".join(out)
+
+    def to_json(self):
+        return {
+            "diagnostics": [
+                {
+                    "code": d.code,
+                    "file": d.file,
+                    "line": d.line,
+                    "message": d.message,
+                    "count": self.repeats.get(i, 1),
+                    "trace": [list(frame) for frame in d.trace],
+                }
+                for i, d in enumerate(self.records)
+            ],
+            "suppressed": dict(sorted(self.suppressed.items())),
+        }
+
+    def dump(self, fp):
+        json.dump(self.to_json(), fp, indent=2)
+
+    def report(self, fp=None):
+        """Write the warnings to fp (stderr by default) as text, then clear them"""
+        text = self.format_text()
+        if text:
+            (fp or sys.stderr).write(text)
+        self.clear()
@@ -0,0 +1,44 @@
+"""Precompiled package files (.dlib), made by python -m dscript pack.
+
+A .dlib file is a json header on the first line, followed by the package's
+latex statements, one per line. The header holds the format version, the source
+it was packed from, the hashes of the files that went into it and the exports:
+for each statement, the name it defines (null if none) and the names it uses.
+"""
+import json
+import os
+
+
+FORMAT = 2
+EXT = ".dlib"
+
+
+def write_dlib(path, header, statements):
+    header = dict(header, format=FORMAT, count=len(statements))
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "w") as f:
+        f.write(json.dumps(header, sort_keys=True))
+        for s in statements:
+            f.write("\n")
+            f.write(s)
+    os.replace(tmp, path)
+
+
+def parse_dlib(data):
+    end = data.find(b"\n")
+    if end == -1:
+        end = len(data)
+    header = json.loads(data[:end])
+    if header.get("format") != FORMAT:
+        raise ValueError(f"Unsupported .dlib format {header.get('format')!r}")
+    body = data[end + 1 :].decode()
+    statements = tuple(body.split("\n")) if header["count"] else ()
+    if not len(statements) == len(header["exports"]) == header["count"]:
+        raise ValueError("Truncated .dlib file")
+    return header, statements
+
+
+def read_dlib(path):
+    """Return the header and statements of a .dlib file"""
+    with open(path, "rb") as f:
+        return parse_dlib(f.read())
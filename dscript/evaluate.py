@@ -0,0 +1,1155 @@
+"""Offline evaluation of compiled graphs, to find broken expressions without desmos.
+This covers the latex convert_to_latex and the standard library produce:
+arithmetic, \\frac and \\sqrt, lists and ranges, points, indexing and filters,
+piecewise \\left\\{...\\right\\}, \\sum and \\prod and the common functions.
+Lists are numpy arrays, plots are evaluated over the viewport, and the graph is
+evaluated again with its sliders at points across their ranges. Each expression
+gets a status and a cost estimate: the work done (array elements computed), the
+longest list and how deeply sums are nested in it.
+Needs numpy, which the compiler itself doesn't (pip install numpy).
+"""
+import collections
+import math
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from . import DEFINITION_RE, PLOT_NAMES
+
+# desmos refuses lists longer than this
+MAX_LIST = 10000
+# array elements computed for one expression before it's reported as expensive
+MAX_WORK = 10**6
+MAX_CALL_DEPTH = 64
+TOKEN_RE = re.compile(
+    r"(?P<space>\s+|\\,|\\ )"
+    r"|\\operatorname\{(?P<func>[a-zA-Z]+)\}"
+    r"|(?P<cmd>\\left\\\{|\\right\\\}|\\left[(\[|]|\\right[)\]|]|\\[a-zA-Z]+|\\[{}])"
+    r"|(?P<num>\d*\.\d+|\d+)"
+    r"|(?P<dots>\.\.\.)"
+    r"|\.(?P<prop>[xy])(?![a-zA-Z_])"
+    r"|(?P<name>[a-zA-Z](?:_\{[a-zA-Z0-9]+\}|_[a-zA-Z0-9])?)"
+    r"|(?P<sym>[-+*/^_{}()\[\],:=<>|~])"
+)
+COMMANDS = {
+    "\\left(": "(",
+    "\\right)": ")",
+    "\\left[": "[",
+    "\\right]": "]",
+    "\\left|": "|",
+    "\\right|": "|",
+    "\\left\\{": "{pw",
+    "\\right\\}": "}pw",
+    "\\{": "{pw",
+    "\\}": "}pw",
+    "\\cdot": "*",
+    "\\times": "*",
+    "\\div": "/",
+    "\\le": "<=",
+    "\\leq": "<=",
+    "\\ge": ">=",
+    "\\geq": ">=",
+    "\\lt": "<",
+    "\\gt": ">",
+}
+# commands that stay as they are
+KEYWORDS = {"\\frac", "\\sqrt", "\\sum", "\\prod", "\\pi", "\\theta", "\\tau"}
+RELATIONS = ("=", "<", ">", "<=", ">=", "~")
+
+Point = collections.namedtuple("Point", "x y")
+Polygon = collections.namedtuple("Polygon", "points")
+ExpressionReport = collections.namedtuple(
+    "ExpressionReport", "index id latex status error max_list sum_depth work"
+)
+
+
+class EvalError(Exception):
+    pass
+
+
+class TooExpensive(EvalError):
+    pass
+
+
+def tokenize(latex):
+    tokens = []
+    pos = 0
+    while pos < len(latex):
+        m = TOKEN_RE.match(latex, pos)
+        if m is None:
+            raise EvalError(f"unexpected {latex[pos]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == "space":
+            continue
+        if kind == "func" and text == "for":
+            kind = "sym"
+        if kind == "cmd":
+            if text in COMMANDS:
+                kind, text = "sym", COMMANDS[text]
+            elif text in KEYWORDS:
+                pass
+            elif text[1:] in UNARY or text[1:] in AGGREGATES:
+                kind, text = "func", text[1:]
+            else:
+                raise EvalError(f"unknown command {text}")
+        tokens.append((kind, text))
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser from latex to tuples of (node type, ...)"""
+
+    END = ("end", "")
+
+    def __init__(self, latex, functions=()):
+        self.tokens = tokenize(latex)
+        self.pos = 0
+        self.functions = functions
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else self.END
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def at(self, *texts):
+        kind, text = self.peek()
+        return kind in ("sym", "cmd", "dots") and text in texts
+
+    def expect(self, text):
+        if not self.at(text):
+            found = self.peek()[1] or "end of expression"
+            raise EvalError(f"expected {text!r}, found {found!r}")
+        self.next()
+
+    def parse(self):
+        node = self.relation()
+        if self.pos < len(self.tokens):
+            raise EvalError(f"unexpected {self.peek()[1]!r}")
+        return node
+
+    def relation(self):
+        operands = [self.expression()]
+        ops = []
+        while self.at(*RELATIONS):
+            ops.append(self.next()[1])
+            operands.append(self.expression())
+        return ("compare", ops, operands) if ops else operands[0]
+
+    def expression(self):
+        node = self.term()
+        while self.at("+", "-"):
+            op = self.next()[1]
+            node = ("binop", op, node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while True:
+            if self.at("*", "/"):
+                op = self.next()[1]
+                node = ("binop", op, node, self.unary())
+            elif self.starts_primary():
+                node = ("binop", "*", node, self.power())
+            else:
+                return node
+
+    def starts_primary(self):
+        kind, text = self.peek()
+        return kind in ("num", "name", "func") or (
+            kind in ("sym", "cmd") and text in ("(", "[", "{pw") or text in KEYWORDS
+        )
+
+    def unary(self):
+        if self.at("-"):
+            self.next()
+            return ("neg", self.unary())
+        if self.at("+"):
+            self.next()
+            return self.unary()
+        return self.power()
+
+    def power(self):
+        node = self.postfix()
+        while self.at("^"):
+            self.next()
+            node = ("binop", "^", node, self.exponent())
+        return node
+
+    def exponent(self):
+        """A braced group, or the single character after a ^ or _"""
+        kind, text = self.peek()
+        if self.at("{"):
+            return self.group()
+        if kind == "num" and len(text) > 1:
+            # x^23 is x^2 * 3
+            self.tokens[self.pos] = ("num", text[1:])
+            return ("num", float(text[0]))
+        return self.primary()
+
+    def group(self):
+        self.expect("{")
+        node = self.relation()
+        self.expect("}")
+        return node
+
+    def postfix(self):
+        node = self.primary()
+        while True:
+            kind, text = self.peek()
+            if self.at("[") and node[0] != "num":
+                self.next()
+                node = ("index", node, self.list_literal())
+            elif kind == "prop":
+                self.next()
+                node = ("prop", node, text)
+            else:
+                return node
+
+    def items(self, close):
+        items = [self.relation()]
+        while self.at(","):
+            self.next()
+            items.append(self.relation())
+        self.expect(close)
+        return items
+
+    def arguments(self):
+        self.expect("(")
+        return self.items(")")
+
+    def primary(self):
+        kind, text = self.next()
+        if kind == "num":
+            return ("num", float(text))
+        if kind == "name":
+            if text in self.functions and self.at("("):
+                return ("call", text, self.arguments())
+            return ("var", text)
+        if kind == "func":
+            power = None
+            if self.at("^"):
+                # \sin^{2}\left(x\right)
+                self.next()
+                power = self.exponent()
+            if self.at("("):
+                node = ("func", text, self.arguments())
+            else:
+                # \sin x
+                node = ("func", text, [self.power()])
+            return node if power is None else ("binop", "^", node, power)
+        if text == "(":
+            items = self.items(")")
+            return items[0] if len(items) == 1 else ("point", items)
+        if text == "[":
+            return self.list_literal()
+        if text == "{pw":
+            return self.piecewise()
+        if text == "{":
+            node = self.relation()
+            self.expect("}")
+            return node
+        if text == "|":
+            node = self.expression()
+            self.expect("|")
+            return ("func", "abs", [node])
+        if text == "\\frac":
+            return ("binop", "/", self.group(), self.group())
+        if text == "\\sqrt":
+            if self.at("["):
+                self.next()
+                n = self.expression()
+                self.expect("]")
+                return ("func", "nthroot", [self.group(), n])
+            return ("func", "sqrt", [self.group()])
+        if text in ("\\sum", "\\prod"):
+            return self.sum(text[1:])
+        if text in ("\\pi", "\\tau"):
+            return ("num", math.pi if text == "\\pi" else 2 * math.pi)
+        if text == "\\theta":
+            return ("var", text)
+        raise EvalError(f"unexpected {text or 'end of expression'!r}")
+
+    def list_literal(self):
+        """The rest of a list or range after its ["""
+        if self.at("]"):
+            self.next()
+            return ("list", [])
+        items = []
+        while True:
+            if self.at("..."):
+                self.next()
+                items.append(None)
+            else:
+                items.append(self.relation())
+                if len(items) == 1 and self.at("for"):
+                    return self.comprehension(items[0])
+            if self.at(","):
+                self.next()
+            elif self.at("]"):
+                self.next()
+                break
+            elif not (self.at("...") or items[-1] is None):
+                raise EvalError(f"expected ']', found {self.peek()[1]!r}")
+        if None not in items:
+            return ("list", items)
+        i = items.index(None)
+        if len(items) - i != 2 or i not in (1, 2) or items[-1] is None:
+            raise EvalError("ranges must be [a,...,b] or [a,b,...,c]")
+        return ("range", items[0], items[1] if i == 2 else None, items[-1])
+
+    def comprehension(self, body):
+        """The rest of a list comprehension [body for n=list] after its body"""
+        self.expect("for")
+        kind, var = self.next()
+        if kind != "name":
+            raise EvalError(f"expected a variable after for, found {var!r}")
+        self.expect("=")
+        source = self.expression()
+        self.expect("]")
+        return ("comprehension", body, var, source)
+
+    def piecewise(self):
+        """The rest of a piecewise expression after its \\left\\{"""
+        branches = []
+        default = None
+        if self.at("}pw"):
+            self.next()
+            return ("num", 1.0)
+        while True:
+            cond = self.relation()
+            if self.at(":"):
+                self.next()
+                branches.append((cond, self.relation()))
+            elif cond[0] == "compare":
+                branches.append((cond, ("num", 1.0)))
+            else:
+                default = cond
+                self.expect("}pw")
+                break
+            if self.at(","):
+                self.next()
+            else:
+                self.expect("}pw")
+                break
+        return ("piecewise", branches, default)
+
+    def sum(self, op):
+        self.expect("_")
+        self.expect("{")
+        kind, var = self.next()
+        if kind != "name":
+            raise EvalError(f"expected the {op} variable, found {var!r}")
+        self.expect("=")
+        start = self.expression()
+        self.expect("}")
+        self.expect("^")
+        return ("sum", op, var, start, self.exponent(), self.term())
+
+
+def align(*values):
+    """Cut lists to the shortest one, as desmos does in elementwise operations"""
+    lengths = [v.shape[0] for v in values if v.ndim]
+    if not lengths or min(lengths) == max(lengths):
+        return values
+    n = min(lengths)
+    return tuple(v[:n] if v.ndim else v for v in values)
+
+
+def components(v):
+    return (v.x, v.y) if isinstance(v, Point) else (v, v)
+
+
+def where(cond, a, b):
+    if isinstance(a, Point) or isinstance(b, Point):
+        if not (isinstance(a, Point) or np.isnan(a).all()) or not (
+            isinstance(b, Point) or np.isnan(b).all()
+        ):
+            raise EvalError("piecewise branches mix points and numbers")
+        (ax, ay), (bx, by) = components(a), components(b)
+        return Point(where(cond, ax, bx), where(cond, ay, by))
+    if isinstance(a, Polygon) or isinstance(b, Polygon):
+        raise EvalError("piecewise polygons are not supported")
+    cond, a, b = align(cond, a, b)
+    return np.where(cond, a, b)
+
+
+def size(v):
+    if isinstance(v, Point):
+        return 2 * v.x.size
+    if isinstance(v, Polygon):
+        return size(v.points)
+    return v.size
+
+
+def length(v):
+    if isinstance(v, Point):
+        return length(v.x)
+    if isinstance(v, Polygon):
+        return 0
+    return v.shape[0] if v.ndim else 0
+
+
+def numbers(v, what):
+    if isinstance(v, np.generic):
+        return np.asarray(v)
+    if not isinstance(v, np.ndarray):
+        raise EvalError(f"{what} needs numbers, not a {type(v).__name__.lower()}")
+    return v
+
+
+def quiet(fn):
+    """Wrap a numpy function to return nan where desmos is undefined"""
+
+    def call(*args):
+        with np.errstate(all="ignore"):
+            return fn(*args)
+
+    return call
+
+
+def nth_root(x, n):
+    # odd roots of negative numbers are real in desmos
+    root = np.abs(x) ** (1 / n)
+    odd = (n % 2 == 1) & (n == np.round(n))
+    return np.where(x >= 0, root, np.where(odd, -root, np.nan))
+
+
+def combinations(n, k):
+    f = math.factorial
+    return np.vectorize(
+        lambda n, k: (
+            float(f(int(n)) // f(int(k)) // f(int(n - k))) if 0 <= k <= n else 0.0
+        )
+    )(n, k)
+
+
+def factorial(x):
+    return np.vectorize(
+        lambda v: float(math.factorial(int(v))) if 0 <= v == int(v) else np.nan
+    )(x)
+
+
+CONSTANTS = {"e": math.e}
+
+if np is None:
+    UNARY = BINARY = AGGREGATES = OPERATORS = COMPARISONS = {}
+else:
+    UNARY = {
+        name: quiet(fn)
+        for name, fn in {
+            "sin": np.sin,
+            "cos": np.cos,
+            "tan": np.tan,
+            "csc": lambda x: 1 / np.sin(x),
+            "sec": lambda x: 1 / np.cos(x),
+            "cot": lambda x: 1 / np.tan(x),
+            "arcsin": np.arcsin,
+            "arccos": np.arccos,
+            "arctan": np.arctan,
+            "sinh": np.sinh,
+            "cosh": np.cosh,
+            "tanh": np.tanh,
+            "floor": np.floor,
+            "ceil": np.ceil,
+            "round": np.round,
+            "abs": np.abs,
+            "sign": np.sign,
+            "exp": np.exp,
+            "ln": np.log,
+            "log": np.log10,
+            "sqrt": np.sqrt,
+            "factorial": factorial,
+        }.items()
+    }
+    BINARY = {
+        name: quiet(fn)
+        for name, fn in {
+            "mod": lambda a, b: a - b * np.floor(a / b),
+            "nthroot": nth_root,
+            "nCr": combinations,
+            "nPr": lambda n, k: combinations(n, k) * factorial(np.maximum(k, 0)),
+            "gcd": lambda a, b: np.gcd(a.astype(int), b.astype(int)).astype(float),
+            "lcm": lambda a, b: np.lcm(a.astype(int), b.astype(int)).astype(float),
+            "arctan": np.arctan2,
+        }.items()
+    }
+    # functions of a whole list, or of all their arguments when given several
+    AGGREGATES = {
+        name: quiet(fn)
+        for name, fn in {
+            "total": np.sum,
+            "min": np.min,
+            "max": np.max,
+            "mean": np.mean,
+            "median": np.median,
+            "stdev": lambda a: np.std(a, ddof=1),
+            "stdevp": np.std,
+            "var": lambda a: np.var(a, ddof=1),
+        }.items()
+    }
+    OPERATORS = {
+        "+": np.add,
+        "-": np.subtract,
+        "*": np.multiply,
+        "/": np.divide,
+        "^": np.power,
+    }
+    COMPARISONS = {
+        "=": np.equal,
+        "<": np.less,
+        ">": np.greater,
+        "<=": np.less_equal,
+        ">=": np.greater_equal,
+    }
+
+
+class Cost:
+    __slots__ = ("work", "max_list")
+
+    def __init__(self):
+        self.work = 0
+        self.max_list = 0
+
+
+class Evaluator:
+    """Evaluates the expressions of one calc_state, with x and y over a range"""
+
+    def __init__(self, definitions, functions, bindings, max_work=MAX_WORK):
+        # name -> node, and name -> (params, node)
+        self.definitions = definitions
+        self.functions = functions
+        self.bindings = bindings
+        self.max_work = max_work
+        self.values = {}
+        self.costs = {}
+        self.locals = {}
+        self.evaluating = []
+        self.calls = []
+        self.cost_stack = []
+        self.last_cost = Cost()
+
+    def evaluate(self, node):
+        """Evaluate node, returning its value and cost"""
+        self.cost_stack.append(Cost())
+        try:
+            return self.eval(node), self.cost_stack[-1]
+        finally:
+            self.last_cost = self.cost_stack.pop()
+
+    def count(self, v):
+        if isinstance(v, np.generic):
+            v = np.asarray(v)
+        cost = self.cost_stack[-1]
+        cost.work += size(v)
+        cost.max_list = max(cost.max_list, length(v))
+        if cost.work > self.max_work:
+            raise TooExpensive(f"computes more than {self.max_work} values")
+        return v
+
+    def eval(self, node):
+        return self.count(getattr(self, "eval_" + node[0])(*node[1:]))
+
+    def eval_num(self, value):
+        return np.asarray(value)
+
+    def eval_var(self, name):
+        if name in self.locals:
+            return self.locals[name]
+        if name in self.bindings:
+            return self.bindings[name]
+        if name in self.definitions:
+            return self.variable(name)
+        if name in self.functions:
+            raise EvalError(f"{name} is a function, but is used without arguments")
+        if name in CONSTANTS:
+            return np.asarray(CONSTANTS[name])
+        raise EvalError(f"{name} is not defined")
+
+    def variable(self, name):
+        if name not in self.values:
+            if name in self.evaluating:
+                raise EvalError(f"{name} depends on itself")
+            saved, self.locals = self.locals, {}
+            self.evaluating.append(name)
+            try:
+                value, _ = self.evaluate(self.definitions[name])
+            except EvalError as e:
+                value = e
+            finally:
+                self.locals = saved
+                self.evaluating.pop()
+            self.values[name] = value
+            self.costs[name] = self.last_cost
+        value = self.values[name]
+        if isinstance(value, TooExpensive):
+            raise TooExpensive(f"uses {name}, which is too expensive")
+        if isinstance(value, EvalError):
+            raise EvalError(f"uses {name}, which has an error")
+        return value
+
+    def eval_call(self, name, args):
+        if self.functions[name] is None:
+            raise EvalError(f"uses {name}, which has an error")
+        params, body = self.functions[name]
+        if len(args) != len(params):
+            raise EvalError(
+                f"{name} takes {len(params)} arguments but was given {len(args)}"
+            )
+        if name in self.calls:
+            raise EvalError(f"{name} calls itself")
+        if len(self.calls) >= MAX_CALL_DEPTH:
+            raise EvalError("functions are nested too deeply")
+        values = [self.eval(a) for a in args]
+        saved, self.locals = self.locals, dict(zip(params, values))
+        self.calls.append(name)
+        try:
+            return self.eval(body)
+        finally:
+            self.locals = saved
+            self.calls.pop()
+
+    def eval_func(self, name, args):
+        values = [self.eval(a) for a in args]
+        if name == "length":
+            if len(values) != 1:
+                raise EvalError("length takes one list")
+            v = values[0]
+            return np.asarray(float(length(v) if isinstance(v, Point) or v.ndim else 1))
+        if name == "polygon":
+            points = values[0] if len(values) == 1 else self.point_list(values)
+            if not isinstance(points, Point):
+                raise EvalError("polygon needs points")
+            return Polygon(points)
+        if name in AGGREGATES:
+            if len(values) > 1:
+                a = np.concatenate([np.atleast_1d(numbers(v, name)) for v in values])
+            else:
+                a = np.atleast_1d(numbers(values[0], name))
+            return np.asarray(AGGREGATES[name](a) if a.size else np.nan)
+        if name in UNARY and len(values) == 1:
+            return UNARY[name](numbers(values[0], name))
+        if name in BINARY and len(values) == 2:
+            a, b = align(numbers(values[0], name), numbers(values[1], name))
+            return BINARY[name](a, b)
+        if name in UNARY or name in BINARY:
+            raise EvalError(f"wrong number of arguments to {name}")
+        raise EvalError(f"unsupported function {name}")
+
+    def point_list(self, values):
+        if not all(isinstance(v, Point) and v.x.ndim == 0 for v in values):
+            raise EvalError("lists can't mix points and numbers")
+        return Point(
+            np.array([v.x for v in values], dtype=float),
+            np.array([v.y for v in values], dtype=float),
+        )
+
+    def eval_binop(self, op, a, b):
+        return self.operate(op, self.eval(a), self.eval(b))
+
+    def operate(self, op, a, b):
+        if isinstance(a, Polygon) or isinstance(b, Polygon):
+            raise EvalError("can't do arithmetic on polygons")
+        if isinstance(a, Point) or isinstance(b, Point):
+            if op in "+-" and not (isinstance(a, Point) and isinstance(b, Point)):
+                raise EvalError(
+                    f"can't {'add' if op == '+' else 'subtract'} "
+                    "a point and a number"
+                )
+            if op in "*/^" and isinstance(a, Point) == isinstance(b, Point):
+                raise EvalError(f"can't use {op} on two points")
+            if op in "/^" and isinstance(b, Point):
+                raise EvalError(f"can't use {op} with a point on the right")
+            (ax, ay), (bx, by) = components(a), components(b)
+            return Point(self.arith(op, ax, bx), self.arith(op, ay, by))
+        return self.arith(op, a, b)
+
+    def arith(self, op, a, b):
+        a, b = align(numbers(a, op), numbers(b, op))
+        with np.errstate(all="ignore"):
+            return np.asarray(OPERATORS[op](a, b))
+
+    def eval_neg(self, a):
+        a = self.eval(a)
+        if isinstance(a, Point):
+            return Point(-a.x, -a.y)
+        return -numbers(a, "-")
+
+    def eval_residual(self, lhs, rhs):
+        return np.atleast_1d(
+            numbers(self.operate("-", self.eval(lhs), self.eval(rhs)), "~")
+        )
+
+    def eval_compare(self, ops, operands):
+        values = [self.eval(o) for o in operands]
+        result = None
+        for op, a, b in zip(ops, values, values[1:]):
+            if op == "~":
+                raise EvalError("regressions are not evaluated")
+            a, b = align(numbers(a, op), numbers(b, op))
+            with np.errstate(all="ignore"):
+                c = COMPARISONS[op](a, b)
+            result = c if result is None else np.logical_and(*align(result, c))
+        return result
+
+    def eval_point(self, items):
+        if len(items) != 2:
+            raise EvalError(f"points need 2 coordinates, not {len(items)}")
+        x, y = align(*(numbers(self.eval(i), "a point") for i in items))
+        if x.ndim != y.ndim:
+            # a point with one list coordinate is a list of points
+            x, y = np.broadcast_arrays(x, y)
+        return Point(x.astype(float), y.astype(float))
+
+    def eval_list(self, items):
+        values = [self.eval(i) for i in items]
+        if values and isinstance(values[0], Point):
+            return self.point_list(values)
+        for v in values:
+            if not isinstance(v, np.ndarray) or v.ndim:
+                raise EvalError("lists can't contain lists")
+        return self.check_length(np.array(values, dtype=float))
+
+    def check_length(self, v):
+        if length(v) > MAX_LIST:
+            raise EvalError(f"list of {length(v)} elements is over desmos' {MAX_LIST}")
+        return v
+
+    def eval_range(self, start, second, end):
+        start = self.scalar(start, "range start")
+        end = self.scalar(end, "range end")
+        if second is None:
+            step = 1.0 if end >= start else -1.0
+        else:
+            step = self.scalar(second, "range step") - start
+        if not (math.isfinite(start) and math.isfinite(end) and math.isfinite(step)):
+            return np.array([], dtype=float)
+        if step == 0 or (end - start) / step < 0:
+            raise EvalError("range never reaches its end")
+        n = math.floor((end - start) / step + 1e-9) + 1
+        if n > MAX_LIST:
+            raise EvalError(f"list of {n} elements is over desmos' {MAX_LIST}")
+        return start + step * np.arange(n)
+
+    def scalar(self, node, what):
+        v = self.eval(node)
+        if not isinstance(v, np.ndarray) or v.ndim:
+            raise EvalError(f"{what} must be a number")
+        return float(v)
+
+    def eval_index(self, a, index):
+        a = self.eval(a)
+        if index[0] == "list" and len(index[1]) == 1:
+            index = index[1][0]
+        i = self.eval(index)
+        if isinstance(a, Point):
+            return Point(self.take(a.x, i), self.take(a.y, i))
+        return self.take(numbers(a, "indexing"), i)
+
+    def take(self, a, i):
+        if a.ndim == 0:
+            raise EvalError("can't index a number")
+        i = numbers(i, "an index")
+        if i.dtype == bool:
+            a, i = align(a, i)
+            return a[i] if i.ndim else (a if i else a[:0])
+        valid = (i >= 1) & (i <= a.shape[0]) & (i == np.floor(i))
+        if not a.shape[0]:
+            return np.full(i.shape, np.nan)
+        return np.where(valid, a[np.where(valid, i, 1).astype(int) - 1], np.nan)
+
+    def eval_prop(self, a, prop):
+        a = self.eval(a)
+        if not isinstance(a, Point):
+            raise EvalError(f".{prop} of something that isn't a point")
+        return getattr(a, prop)
+
+    def eval_piecewise(self, branches, default):
+        result = self.eval(default) if default is not None else np.asarray(np.nan)
+        for cond, value in reversed(branches):
+            c = self.eval(cond)
+            if c is None or not isinstance(c, np.ndarray) or c.dtype != bool:
+                raise EvalError("piecewise conditions must be comparisons")
+            result = where(c, self.eval(value), result)
+        return result
+
+    def eval_sum(self, op, var, start, end, body):
+        start = numbers(self.eval(start), op)
+        end = numbers(self.eval(end), op)
+        start, end = align(start, end)
+        if start.ndim == 0 and end.ndim == 0:
+            return self.sum_range(op, var, float(start), float(end), body)
+        # list bounds give a list of sums
+        start, end = np.broadcast_arrays(start, end)
+        sums = [
+            self.sum_range(op, var, float(s), float(e), body)
+            for s, e in zip(start, end)
+        ]
+        for s in sums:
+            if not isinstance(s, np.ndarray) or s.ndim:
+                raise EvalError(f"{op} over a list must give numbers")
+        return np.array(sums, dtype=float)
+
+    def sum_range(self, op, var, start, end, body):
+        if not (math.isfinite(start) and math.isfinite(end)):
+            return np.asarray(np.nan)
+        saved = self.locals
+        if self.vectorizable(body, var):
+            # every term at once
+            terms = self.map(body, var, np.arange(round(start), round(end) + 1.0))
+            return np.asarray(terms.sum() if op == "sum" else terms.prod())
+        total = np.asarray(0.0 if op == "sum" else 1.0)
+        try:
+            for n in range(round(start), round(end) + 1):
+                self.locals = dict(saved, **{var: np.asarray(float(n))})
+                value = self.eval(body)
+                total = self.count(
+                    self.operate("+" if op == "sum" else "*", total, value)
+                )
+        finally:
+            self.locals = saved
+        return total
+
+    def vectorizable(self, body, var):
+        """Whether body can be evaluated for a list of values of var at once"""
+        return elementwise(body) and all(
+            isinstance(v, np.ndarray) and not v.ndim
+            for v in (self.eval(("var", n)) for n in free_names(body) - {var})
+        )
+
+    def map(self, body, var, values):
+        saved, self.locals = self.locals, dict(self.locals, **{var: values})
+        try:
+            return np.broadcast_to(self.eval(body), values.shape)
+        finally:
+            self.locals = saved
+
+    def eval_comprehension(self, body, var, source):
+        values = numbers(self.eval(source), "for")
+        if not values.ndim:
+            raise EvalError(f"{var} in a list comprehension must be given a list")
+        if self.vectorizable(body, var):
+            return np.array(self.map(body, var, values))
+        saved = self.locals
+        results = []
+        try:
+            for v in values:
+                self.locals = dict(saved, **{var: np.asarray(v)})
+                results.append(self.eval(body))
+        finally:
+            self.locals = saved
+        if results and isinstance(results[0], Point):
+            return self.point_list(results)
+        for r in results:
+            if not isinstance(r, np.ndarray) or r.ndim:
+                raise EvalError("list comprehensions must give numbers or points")
+        return self.check_length(np.array(results, dtype=float))
+
+
+def elementwise(node):
+    """Whether node works on lists element by element, like it does on numbers"""
+    if isinstance(node, list):
+        return all(elementwise(n) for n in node)
+    if not isinstance(node, tuple):
+        return True
+    if node[0] in ("num", "var"):
+        return True
+    if node[0] == "func":
+        return (node[1] in UNARY or node[1] in BINARY) and elementwise(node[2])
+    if node[0] == "piecewise":
+        return elementwise([c for b in node[1] for c in b]) and elementwise(node[2])
+    if node[0] == "compare":
+        return "~" not in node[1] and elementwise(node[2])
+    if node[0] in ("binop", "neg"):
+        return elementwise(list(node[1:]))
+    return False
+
+
+def sum_depth(node, functions, seen=()):
+    """How deeply sums are nested in node, following function calls"""
+    if not isinstance(node, tuple):
+        if isinstance(node, list):
+            return max([sum_depth(n, functions, seen) for n in node] or [0])
+        return 0
+    depth = max([sum_depth(n, functions, seen) for n in node[1:]] or [0])
+    if node[0] == "sum":
+        depth += 1
+    elif node[0] == "call" and node[1] not in seen and functions.get(node[1]):
+        body = functions[node[1]][1]
+        depth = max(depth, sum_depth(body, functions, seen + (node[1],)))
+    return depth
+
+
+def called(node, functions, seen=None):
+    """Names of the functions node calls, directly or through other functions"""
+    if seen is None:
+        seen = set()
+    if isinstance(node, list):
+        for n in node:
+            called(n, functions, seen)
+    elif isinstance(node, tuple):
+        if node[0] == "call" and node[1] not in seen:
+            seen.add(node[1])
+            if functions.get(node[1]):
+                called(functions[node[1]][1], functions, seen)
+        called(list(node[1:]), functions, seen)
+    return seen
+
+
+def free_names(node, bound=frozenset()):
+    """Names node uses that aren't bound by a sum inside it"""
+    if isinstance(node, list):
+        return set().union(*[free_names(n, bound) for n in node])
+    if not isinstance(node, tuple):
+        return set()
+    if node[0] == "var":
+        return set() if node[1] in bound else {node[1]}
+    if node[0] == "sum":
+        _, op, var, start, end, body = node
+        return free_names([start, end], bound) | free_names(body, bound | {var})
+    if node[0] == "comprehension":
+        _, body, var, source = node
+        return free_names(source, bound) | free_names(body, bound | {var})
+    return free_names(list(node[1:]), bound)
+
+
+def definition(latex):
+    """Return (name, params or None, right hand side) if latex is a definition"""
+    lhs, eq, rhs = latex.partition("=")
+    m = DEFINITION_RE.match(lhs.strip()) if eq else None
+    if m is None:
+        return None
+    name, params = m.group(1), m.group(2)
+    if params is None:
+        return None if name in PLOT_NAMES else (name, None, rhs)
+    params = [p.strip() for p in params.split(",")]
+    if name in ("x", "y") or not all(DEFINITION_RE.match(p) for p in params):
+        return None
+    return name, params, rhs
+
+
+def viewport_bindings(state, points):
+    viewport = state.get("graph", {}).get("viewport", {})
+    xmin, xmax = viewport.get("xmin", -10), viewport.get("xmax", 10)
+    ymin, ymax = viewport.get("ymin", -10), viewport.get("ymax", 10)
+    return {
+        "x": np.linspace(xmin, xmax, points),
+        "y": np.linspace(ymin, ymax, points),
+        "\\theta": np.linspace(0, 2 * math.pi, points),
+    }
+
+
+def evaluate_state(state, samples=3, points=64, max_work=MAX_WORK):
+    """Evaluate every expression of a calc_state, returning an ExpressionReport each.
+    The graph is evaluated as it is, then with every slider moved together to
+    samples points from the bottom to the top of its range. An expression's
+    status is the worst it got: "ok", "expensive" or "error", and its cost is
+    the most it took. Regressions aren't fitted: their residuals are taken with
+    any parameters they fit at 1.
+    """
+    if np is None:
+        raise ImportError("evaluating graphs needs numpy (pip install numpy)")
+    records = [
+        (i, exp)
+        for i, exp in enumerate(state["expressions"]["list"])
+        if exp.get("type", "expression") == "expression" and exp.get("latex")
+    ]
+    defined = [definition(exp["latex"]) for _, exp in records]
+    function_names = {d[0] for d in defined if d and d[1] is not None}
+    # parse everything first, so definitions can be used before they appear
+    parsed = []
+    definitions = {}
+    functions = {}
+    duplicates = set()
+    residuals = {}
+    regressions = []
+    for (i, exp), d in zip(records, defined):
+        try:
+            node = Parser(d[2] if d else exp["latex"], function_names).parse()
+            if d and node[0] == "compare":
+                raise EvalError(f"{d[0]} is defined as an equation")
+        except EvalError as e:
+            node = e
+        parsed.append(node)
+        if d is None:
+            if regression(node):
+                # the residuals of a ~ b are a variable desmos names after a
+                node = parsed[-1] = ("residual",) + tuple(node[2])
+                name = exp.get("residualVariable") or residual_name(node[1])
+                if name:
+                    residuals[name] = node
+                regressions.append(node)
+            continue
+        name, params, _ = d
+        if name in definitions or name in functions:
+            duplicates.add(name)
+        elif isinstance(node, EvalError):
+            # never evaluated, see below
+            (definitions if params is None else functions)[name] = None
+        elif params is None:
+            definitions[name] = node
+        else:
+            functions[name] = (params, node)
+    for name, node in residuals.items():
+        if name in definitions or name in functions:
+            duplicates.add(name)
+        else:
+            definitions[name] = node
+    for node in regressions:
+        for name in free_names(node[2]):
+            # a parameter the regression fits
+            definitions.setdefault(name, ("num", 1.0))
+    for name in duplicates:
+        # a name can only have one definition
+        if name in definitions:
+            definitions[name] = None
+        if name in functions:
+            functions[name] = None
+    broken = {d[0] for d, n in zip(defined, parsed) if d and isinstance(n, EvalError)}
+
+    bindings = viewport_bindings(state, points)
+    sliders = {}
+    results = [None] * len(records)
+    fractions = [None] + list(np.linspace(0, 1, samples)) if samples else [None]
+    for fraction in fractions:
+        values = {}
+        if fraction is not None:
+            if not sliders:
+                break
+            values = {n: lo + (hi - lo) * fraction for n, (lo, hi) in sliders.items()}
+        evaluator = Evaluator(
+            {
+                n: ("num", values[n]) if n in values else node
+                for n, node in definitions.items()
+            },
+            functions,
+            bindings,
+            max_work,
+        )
+        for n in definitions:
+            if n in duplicates:
+                evaluator.values[n] = EvalError(f"{n} is defined more than once")
+            elif n in broken:
+                evaluator.values[n] = EvalError(f"{n} has a syntax error")
+        for k, ((i, exp), d, node) in enumerate(zip(records, defined, parsed)):
+            result = evaluate_record(evaluator, exp, d, node, functions, broken)
+            if fraction is None and d and d[1] is None and exp.get("slider"):
+                bounds = slider_bounds(evaluator, exp["slider"], function_names)
+                if isinstance(bounds, EvalError):
+                    result = ("error", f"slider: {bounds}", 0, 0)
+                elif bounds is not None:
+                    sliders[d[0]] = bounds
+            if fraction is not None and result[0] in ("error", "expensive"):
+                result = (
+                    result[0],
+                    f"{result[1]} (with sliders at {fraction:.0%} of their range)",
+                    result[2],
+                    result[3],
+                )
+            results[k] = worst(results[k], result)
+    reports = []
+    for (i, exp), node, (status, error, work, max_list) in zip(
+        records, parsed, results
+    ):
+        depth = 0 if isinstance(node, EvalError) else sum_depth(node, functions)
+        reports.append(
+            ExpressionReport(
+                i, exp.get("id"), exp["latex"], status, error, max_list, depth, work
+            )
+        )
+    return reports
+
+
+STATUSES = ["ok", "expensive", "error"]
+
+
+def regression(node):
+    return isinstance(node, tuple) and node[0] == "compare" and node[1] == ["~"]
+
+
+def residual_name(lhs):
+    if lhs[0] == "var" and "_" in lhs[1]:
+        return "e_" + lhs[1].split("_", 1)[1]
+    return None
+
+
+def worst(a, b):
+    if a is None:
+        return b
+    status = max(a[0], b[0], key=STATUSES.index)
+    error = a[1] if STATUSES.index(a[0]) >= STATUSES.index(b[0]) else b[1]
+    return (status, error, max(a[2], b[2]), max(a[3], b[3]))
+
+
+def evaluate_record(evaluator, exp, d, node, functions, broken):
+    """Return (status, error, work, max list) for one expression"""
+    if isinstance(node, EvalError):
+        return ("error", f"syntax: {node}", 0, 0)
+    try:
+        if d is None:
+            _, cost = evaluator.evaluate(node)
+            return ("ok", None, cost.work, cost.max_list)
+        name, params, _ = d
+        if params is None:
+            try:
+                evaluator.variable(name)
+            except EvalError:
+                pass
+            value = evaluator.values[name]
+            cost = evaluator.costs.get(name) or Cost()
+            if isinstance(value, TooExpensive):
+                return ("expensive", str(value), cost.work, cost.max_list)
+            if isinstance(value, EvalError):
+                return ("error", str(value), cost.work, cost.max_list)
+            return ("ok", None, cost.work, cost.max_list)
+        if functions.get(name) is None:
+            raise EvalError(f"{name} is defined more than once")
+        # functions are evaluated where they are called, so only check their names
+        if name in called(node, functions):
+            raise EvalError(f"{name} calls itself")
+        for n in sorted(free_names(node) - set(params)):
+            if n in broken:
+                raise EvalError(f"uses {n}, which has an error")
+            if not (
+                n in evaluator.definitions
+                or n in evaluator.bindings
+                or n in CONSTANTS
+                or n in functions
+            ):
+                raise EvalError(f"{n} is not defined")
+        return ("ok", None, 0, 0)
+    except TooExpensive as e:
+        cost = evaluator.last_cost
+        return ("expensive", str(e), cost.work, cost.max_list)
+    except EvalError as e:
+        return ("error", str(e), 0, 0)
+
+
+def slider_bounds(evaluator, slider, functions):
+    """Return a slider's (min, max), None if it has none, or an EvalError"""
+    bounds = []
+    for key in ("min", "max"):
+        if key not in slider:
+            return None
+        try:
+            node = Parser(str(slider[key]), functions).parse()
+            value, _ = evaluator.evaluate(node)
+        except EvalError as e:
+            return e
+        if not isinstance(value, np.ndarray) or value.ndim:
+            return EvalError(f"slider {key} must be a number")
+        bounds.append(float(value))
+    if not all(math.isfinite(b) for b in bounds):
+        return None
+    return tuple(bounds)
+
+
+def evaluate_graph(graph, **kwargs):
+    """evaluate_state for a compiled DesmosScript"""
+    return evaluate_state(graph.json(), **kwargs)
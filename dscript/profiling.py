@@ -0,0 +1,78 @@
+"""Timing of the compiler's stages, enabled with DesmosScript(profile=True)"""
+import json
+import time
+
+
+class Profiler:
+    """Call counts and cumulative times for named stages, and time per source line.
+
+    Statement handlers are counted each time one is tried on a line. Times are
+    inclusive: an include's time covers the statements of the package it
+    compiled, and so does the time of the line and Include handler using it.
+    """
+
+    def __init__(self):
+        # name -> [calls, seconds]
+        self.stats = {}
+        # "file:line" -> [seconds, source]
+        self.lines = {}
+
+    def add(self, name, seconds):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = [0, 0.0]
+        stat[0] += 1
+        stat[1] += seconds
+
+    def call(self, name, fn, *args):
+        """Call fn with args, adding its time to name"""
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add_line(self, location, seconds, source):
+        line = self.lines.get(location)
+        if line is None:
+            self.lines[location] = [seconds, source]
+        else:
+            line[0] += seconds
+
+    def slowest_lines(self, top=10):
+        return sorted(self.lines.items(), key=lambda i: i[1][0], reverse=True)[:top]
+
+    def to_json(self, top=10):
+        return {
+            "stats": [
+                {"name": name, "calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in sorted(
+                    self.stats.items(), key=lambda i: i[1][1], reverse=True
+                )
+            ],
+            "slowest_lines": [
+                {"location": location, "seconds": seconds, "source": source}
+                for location, (seconds, source) in self.slowest_lines(top)
+            ],
+        }
+
+    def dump(self, fp, top=10):
+        json.dump(self.to_json(top), fp, indent=2)
+
+    def report(self, top=10):
+        """Return the stats and slowest lines as a table"""
+        data = self.to_json(top)
+        rows = [f"{'stage':<32} {'calls':>8} {'total ms':>10} {'mean us':>10}"]
+        for s in data["stats"]:
+            rows.append(
+                f"{s['name'][:32]:<32} {s['calls']:>8} {s['seconds'] * 1e3:>10.2f} "
+                f"{s['seconds'] / s['calls'] * 1e6:>10.1f}"
+            )
+        rows.append("")
+        rows.append(f"{'slowest lines':<32} {'total ms':>10}  source")
+        for l in data["slowest_lines"]:
+            rows.append(
+                f"{l['location'][-32:]:<32} {l['seconds'] * 1e3:>10.2f}  "
+                f"{l['source'][:60]}"
+            )
+        return "\n".join(rows)
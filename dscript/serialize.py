@@ -0,0 +1,66 @@
+"""Compact, key sorted json for compiled graphs.
+
+The output is the same as json.dumps(data, separators=(",", ":"), sort_keys=True),
+so it can be hashed and uploaded as is, but is written straight from the graph's
+expression records instead of building the nested dict first.
+"""
+import collections
+import json
+from json.encoder import encode_basestring_ascii as encode_string
+
+
+SEPARATORS = (",", ":")
+
+# A calc_state's json, with each expression's id and json and the calc_state's
+#  other keys, so it can be hashed per expression without parsing it back
+EncodedState = collections.namedtuple(
+    "EncodedState", ["calc_state", "expressions", "other"]
+)
+
+# the calc_state around the expression list, in sorted key order
+STATE_START = '{"expressions":{"list":['
+
+
+def dumps(data):
+    return json.dumps(data, separators=SEPARATORS, sort_keys=True)
+
+
+def encode_value(v):
+    t = type(v)
+    if t is str:
+        return encode_string(v)
+    if t is bool:
+        return "true" if v else "false"
+    if t is int:
+        return int.__repr__(v)
+    return dumps(v)
+
+
+def make_record_encoder(fields):
+    """Return a function encoding a record with the given slot fields as json"""
+    keys = [(f, encode_string(f) + ":") for f in sorted(fields)]
+
+    def encode_record(exp):
+        if exp.extra:
+            # keys outside the fields have to be sorted in with them
+            return dumps(exp.to_dict())
+        parts = []
+        for f, key in keys:
+            v = getattr(exp, f)
+            if v is not None:
+                parts.append(key + encode_value(v))
+        return "{" + ",".join(parts) + "}"
+
+    return encode_record
+
+
+def state_end(viewport, randseed, version=7):
+    return (
+        ']},"graph":{"viewport":'
+        + dumps(viewport)
+        + '},"randomSeed":'
+        + encode_value(randseed)
+        + ',"version":'
+        + encode_value(version)
+        + "}"
+    )
@@ -1,30 +1,39 @@
+import hashlib
 import os
 from getpass import getpass
 import sys
+import time
 
 import dscript
 from client import DesmosClient
 
+# seconds between checks for changed files, and that they must stay unchanged
+#  before rebuilding, so an editor's save is only built once
+POLL_INTERVAL = 0.1
+DEBOUNCE = 0.25
+
 
 def shell():
+    # lines are added to one graph, so folders, colors and includes carry over
+    g = dscript.DesmosScript(incremental=True)
     while True:
         c = input(">> ")
-        g = dscript.DesmosScript()
-        g.parse(c)
-        print("\n".join(g.get_latex_statements()))
-
+        diff = g.apply_edit(len(g.lines), len(g.lines), c)
+        print(
+            "\n".join(
+                e["latex"] for e in diff.added + diff.changed if e["type"] == "expression"
+            )
+        )
 
-def process(script):
-    with open(script, "r") as f:
-        code = f.read()
 
-    print("Compiling...")
-    data = dscript.desmos_compile(code)
-    if len(sys.argv) > 2:
-        graph_hash = sys.argv[2]
+def login(hash_arg):
+    """Return a logged in DesmosClient and the graph hash to upload to"""
+    if len(sys.argv) > hash_arg:
+        graph_hash = sys.argv[hash_arg]
     else:
         graph_hash = input(
-            "Enter graph hash to upload to (can be passed on command line as 3rd arg): "
+            "Enter graph hash to upload to "
+            f"(can be passed on command line as arg {hash_arg + 1}): "
         )
     username = os.getenv("DESMOS_USER") or input(
         "Desmos Username (can be passed in DESMOS_USER environment variable): "
@@ -33,14 +42,141 @@ def process(script):
         "Desmos Password (can be passed in DESMOS_PASS environment variable): "
     )
     print("Logging in...")
-    c = DesmosClient()
+    c = DesmosClient(manifest=".desmos-manifest.json")
     c.login(username, password)
-    c.save_graph(data, graph_hash)
+    return c, graph_hash
+
+
+def upload(c, data, graph_hash):
+    res = c.sync(data, graph_hash)
+    d = res.diff
+    print(
+        f"{len(d.added)} added, {len(d.changed)} changed, {len(d.removed)} removed "
+        f"expressions ({d.size} bytes)"
+    )
+    if res.result is None:
+        print("Graph is unchanged, skipped upload")
+
+
+def process(script):
+    with open(script, "r") as f:
+        code = f.read()
+
+    print("Compiling...")
+    g = dscript.DesmosScript()
+    g.parse(code)
+    data = g.encode()
+    c, graph_hash = login(2)
+    upload(c, data, graph_hash)
+
+
+def mtimes(paths):
+    """Return the modification time of each path, None if it doesn't exist"""
+    times = {}
+    for p in paths:
+        try:
+            times[p] = os.stat(p).st_mtime_ns
+        except FileNotFoundError:
+            times[p] = None
+    return times
+
+
+def wait_for_change(paths, times):
+    """Return the paths whose mtimes differ from times once they stop changing"""
+    while True:
+        time.sleep(POLL_INTERVAL)
+        now = mtimes(paths)
+        if now != times:
+            break
+    # debounce: wait until nothing has changed for DEBOUNCE seconds
+    settled = time.monotonic()
+    while time.monotonic() - settled < DEBOUNCE:
+        time.sleep(POLL_INTERVAL)
+        latest = mtimes(paths)
+        if latest != now:
+            now = latest
+            settled = time.monotonic()
+    return [p for p in paths if now[p] != times.get(p)]
+
+
+def rebuild(g, source, packages_changed):
+    """Apply the changes to source to g, returning the number of lines reparsed.
+
+    Only the lines that differ from g's are reparsed. If packages changed,
+    the include lines are reparsed too, which only recompiles the packages
+    whose files changed since the others are in Include.PACKAGE_CACHE.
+    """
+    old = g.lines
+    new = source.split("\n")
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < min(len(old), len(new)) - start and old[-end - 1] == new[-end - 1]:
+        end += 1
+    reparsed = 0
+    if start < len(old) - end or start < len(new) - end:
+        g.apply_edit(start, len(old) - end, new[start : len(new) - end])
+        reparsed += len(new) - end - start
+    if packages_changed:
+        for i, l in enumerate(g.lines):
+            if l.strip().startswith("include"):
+                g.apply_edit(i, i + 1, [l])
+                reparsed += 1
+    return reparsed
+
+
+def watch(script):
+    """Rebuild script whenever it or a file it includes changes, uploading each result
+
+    Keeps the graph between rebuilds, so only the changed lines are parsed again,
+    and one logged in client, so each upload reuses the session and its connection.
+    """
+    c, graph_hash = login(3)
+    g = dscript.DesmosScript(incremental=True)
+    last_digest = None
+    changed = [script]
+    while True:
+        start = time.perf_counter()
+        # taken before reading, so changes made while building aren't missed
+        times = mtimes([script] + sorted(g.includes))
+        try:
+            with open(script, "r") as f:
+                source = f.read()
+            reparsed = rebuild(g, source, any(p != script for p in changed))
+            data = g.encode()
+        except Exception as e:
+            print(f"ERROR: Unable to compile {script}: {e!r}", file=sys.stderr)
+        else:
+            built = time.perf_counter()
+            digest = hashlib.sha256(data.calc_state.encode()).hexdigest()
+            report = f"Rebuilt {script} ({reparsed} lines) in {built - start:.3f}s"
+            if digest == last_digest:
+                print(f"{report}, output unchanged")
+            else:
+                try:
+                    upload(c, data, graph_hash)
+                except Exception as e:
+                    print(f"ERROR: Unable to upload: {e!r}", file=sys.stderr)
+                else:
+                    last_digest = digest
+                    report += f", uploaded in {time.perf_counter() - built:.3f}s"
+                print(report)
+        paths = [script] + sorted(g.includes)
+        # packages included for the first time are as new as this build
+        times = dict(mtimes(paths), **times)
+        print(f"Watching {len(paths)} files...")
+        changed = wait_for_change(paths, times)
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Running dscript shell. Pass a filename to compile from file.")
         shell()
+    elif sys.argv[1] == "watch":
+        if len(sys.argv) < 3:
+            print("Usage: main.py watch <script> [graph hash]")
+            sys.exit(1)
+        watch(sys.argv[2])
     else:
         process(sys.argv[1])
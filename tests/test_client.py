@@ -0,0 +1,198 @@
+"""DesmosClient against a local stand-in for the desmos server"""
+import asyncio
+import collections
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+from client import DesmosClient, UploadManifest
+from client.aio import AsyncDesmosClient
+
+
+class StubThumbnails:
+    def get(self, graph_hash=None, data=None):
+        return ""
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Saves graphs, answering each graph_hash by its name:
+
+    busy-N fails with 503 until its Nth request, limited-N is rate limited with
+    429 until its Nth, down always fails with 500, bad is rejected with 400, and
+    slow-N takes N hundredths of a second. Anything else is saved at once.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        graph_hash = urllib.parse.parse_qs(body.decode())["graph_hash"][0]
+        with self.server.lock:
+            self.server.hits[graph_hash] += 1
+            hits = self.server.hits[graph_hash]
+        name, _, n = graph_hash.partition("-")
+        status, extra = 200, {}
+        if name == "busy" and hits < int(n):
+            status = 503
+        elif name == "limited" and hits < int(n):
+            status, extra = 429, {"Retry-After": "0"}
+        elif name == "down":
+            status = 500
+        elif name == "bad":
+            status = 400
+        elif name == "slow":
+            time.sleep(int(n) / 100)
+        out = json.dumps({"hash": graph_hash, "hits": hits}).encode()
+        self.send_response(status)
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.hits = collections.Counter()
+        self.options = {
+            "base_url": f"http://127.0.0.1:{self.server.server_port}",
+            "retries": 3,
+            "backoff": 0.01,
+            "thumbnails": StubThumbnails(),
+        }
+
+
+class ClientTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.client = DesmosClient(**self.options)
+
+    def tearDown(self):
+        self.client.s.close()
+
+    def test_retries_server_errors(self):
+        self.assertEqual(self.client.save({}, "busy-3"), {"hash": "busy-3", "hits": 3})
+        self.assertEqual(self.server.hits["busy-3"], 3)
+
+    def test_retries_rate_limits(self):
+        res = self.client.save({}, "limited-2")
+        self.assertEqual(res, {"hash": "limited-2", "hits": 2})
+
+    def test_gives_up_after_retries(self):
+        with self.assertRaises(AssertionError):
+            self.client.save({}, "down")
+        self.assertEqual(self.server.hits["down"], self.client.retries + 1)
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(AssertionError):
+            self.client.save({}, "bad")
+        self.assertEqual(self.server.hits["bad"], 1)
+
+    def test_save_many(self):
+        # the first items finish last, and some fail, results stay in item order
+        hashes = [f"slow-{n}" for n in (20, 10, 5, 0)]
+        hashes[1:1] = ["bad", "busy-2", "down"]
+        results = self.client.save_many([({}, h) for h in hashes], max_workers=4)
+        self.assertEqual([r.graph_hash for r in results], hashes)
+        for r in results:
+            if r.graph_hash in ("bad", "down"):
+                self.assertIsNone(r.result)
+                self.assertIsInstance(r.error, AssertionError)
+            else:
+                self.assertIsNone(r.error)
+                self.assertEqual(r.result["hash"], r.graph_hash)
+        self.assertEqual(self.server.hits["busy-2"], 2)
+
+
+class AsyncClientTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.manifest = UploadManifest(os.path.join(self.dir.name, "manifest.json"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_client(self, fn, **options):
+        """Run fn with an AsyncDesmosClient, returning once it has closed"""
+
+        async def run():
+            async with AsyncDesmosClient(
+                manifest=self.manifest, **dict(self.options, **options)
+            ) as c:
+                return await fn(c)
+
+        return asyncio.run(run())
+
+    def test_save(self):
+        async def save(c):
+            return await c.save({}, "busy-2")
+
+        self.assertEqual(self.run_client(save), {"hash": "busy-2", "hits": 2})
+        self.assertEqual(self.manifest.get_parent("busy-2"), "busy-2")
+
+    def test_timeout(self):
+        async def save(c):
+            with self.assertRaises(asyncio.TimeoutError):
+                await c.save({}, "slow-30")
+
+        self.run_client(save, timeout=0.05)
+        # the save landed after the call timed out, so it isn't recorded
+        self.assertEqual(self.server.hits["slow-30"], 1)
+        self.assertIsNone(self.manifest.get_parent("slow-30"))
+
+    def test_cancel(self):
+        async def save(c):
+            task = asyncio.ensure_future(c.save({}, "down"))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        # cancelled while backing off, so the retries are never sent
+        self.run_client(save, backoff=0.5)
+        self.assertEqual(self.server.hits["down"], 1)
+
+    def test_save_many(self):
+        hashes = ["slow-20", "bad", "busy-2", "down", "slow-5", "slow-0"]
+
+        async def save_many(c):
+            return await c.save_many([({}, h) for h in hashes])
+
+        results = self.run_client(save_many, max_in_flight=4)
+        self.assertEqual([r.graph_hash for r in results], hashes)
+        for r in results:
+            if r.graph_hash in ("bad", "down"):
+                self.assertIsNone(r.result)
+                self.assertIsInstance(r.error, AssertionError)
+            else:
+                self.assertIsNone(r.error)
+                self.assertEqual(r.result["hash"], r.graph_hash)
+        # written once, after every save was recorded
+        with open(self.manifest.path) as f:
+            self.assertEqual(
+                sorted(json.load(f)), ["busy-2", "slow-0", "slow-20", "slow-5"]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Warnings raised in included packages, compiled fresh and from the caches"""
+import os
+import tempfile
+import unittest
+
+import dscript
+from dscript.buildcache import BuildCache
+from dscript.diagnostics import Diagnostics
+
+# each file warns, l1 while including l2
+SOURCES = {
+    "l1.dscript": "include l2\nfolder\n",
+    "l2.dscript": "h = 1\nfolder\n",
+    "main.dscript": "include l1\ny = h\nslider 1 to\n",
+}
+
+EXPECTED = [
+    ("l2.dscript", 2, ("l2.dscript", "l1.dscript", "main.dscript")),
+    ("l1.dscript", 2, ("l1.dscript", "main.dscript")),
+    ("main.dscript", 3, ("main.dscript",)),
+]
+
+
+def summary(diagnostics):
+    return [
+        (d.file, d.line, tuple(f for f, _ in reversed(d.trace)))
+        for d in diagnostics
+    ]
+
+
+class NestedIncludeTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        for name, source in SOURCES.items():
+            with open(name, "w") as f:
+                f.write(source)
+        dscript.Include.PACKAGE_CACHE.clear()
+
+    def tearDown(self):
+        dscript.Include.PACKAGE_CACHE.clear()
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def parse(self):
+        diagnostics = Diagnostics()
+        g = dscript.DesmosScript(name="main.dscript", diagnostics=diagnostics)
+        g.parse(SOURCES["main.dscript"])
+        return summary(diagnostics)
+
+    def test_parse(self):
+        self.assertEqual(self.parse(), EXPECTED)
+        # the second parse replays the packages' warnings from PACKAGE_CACHE
+        self.assertEqual(self.parse(), EXPECTED)
+
+    def test_compile_file(self):
+        cache = BuildCache(os.path.join(self.dir.name, "cache"))
+        for _ in range(2):
+            diagnostics = Diagnostics()
+            dscript.compile_file(
+                "main.dscript",
+                "main.djson",
+                build_cache=cache,
+                randseed="0",
+                diagnostics=diagnostics,
+            )
+            self.assertEqual(summary(diagnostics), EXPECTED)
+            dscript.Include.PACKAGE_CACHE.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
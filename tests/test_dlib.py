@@ -0,0 +1,81 @@
+"""Packing packages to .dlib files and including them"""
+import json
+import os
+import tempfile
+import unittest
+
+import dscript
+from dscript import dlib
+from dscript.diagnostics import Diagnostics
+
+PACKAGE = "a = 2\nf(x) = a * x^2\ng(x) = x + 1\nu(x) = 2x\n"
+MAIN = "include pkg\ny = f(x)\n"
+
+
+def output(g):
+    return json.loads(g.dumps())["expressions"]["list"]
+
+
+class DlibTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        with open("pkg.dscript", "w") as f:
+            f.write(PACKAGE)
+        dscript.Include.PACKAGE_CACHE.clear()
+
+    def tearDown(self):
+        dscript.Include.PACKAGE_CACHE.clear()
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def compile(self):
+        diagnostics = Diagnostics()
+        g = dscript.DesmosScript(randseed="0", prune="all", diagnostics=diagnostics)
+        g.parse(MAIN)
+        return g, [d.message for d in diagnostics]
+
+    def test_exports(self):
+        dscript.pack_file("pkg.dscript")
+        header, statements = dlib.read_dlib("pkg.dlib")
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(
+            header["exports"], [["a", []], ["f", ["a"]], ["g", []], ["u", []]]
+        )
+
+    def test_same_output_as_source(self):
+        source, _ = self.compile()
+        dscript.pack_file("pkg.dscript")
+        dscript.Include.PACKAGE_CACHE.clear()
+        packed, warnings = self.compile()
+        self.assertEqual(warnings, [])
+        self.assertEqual(packed.dumps(), source.dumps())
+        self.assertEqual(packed.includes, {"pkg.dlib", "pkg.dscript"})
+        # the records carry the exports, which unused definitions are pruned by
+        self.assertEqual(
+            [e.definition[0] for e in packed.explist if e.package],
+            ["a", "f", "g", "u"],
+        )
+        self.assertEqual(len(output(packed)), 3)
+
+    def test_changed_source(self):
+        dscript.pack_file("pkg.dscript")
+        with open("pkg.dscript", "a") as f:
+            f.write("v = 1\n")
+        g, warnings = self.compile()
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("packed from different sources", warnings[0])
+        self.assertTrue(all(e.definition is None for e in g.explist))
+
+    def test_unreadable(self):
+        with open("pkg.dlib", "w") as f:
+            f.write(json.dumps({"format": 1, "count": 0}))
+        g, warnings = self.compile()
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("Unable to read pkg.dlib", warnings[0])
+        self.assertEqual(len(output(g)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Fuzz DesmosScript.apply_edit against parsing the edited source from scratch"""
+import contextlib
+import io
+import random
+import unittest
+
+import dscript
+
+# lines edits are made of, covering statements that change the last expression,
+#  the folder, color and viewport state, continuations and includes
+LINES = [
+    "y=x",
+    "y = x^2 + 1",
+    "f(x) = |if (x > 1) then 1 else 2|",
+    "slider 0 to 5",
+    "hidden",
+    "label hi there",
+    "labelopts above",
+    "draggable XY",
+    "folder F",
+    "folder-closed G",
+    "endfolder",
+    "xbounds -5,5",
+    "ybounds -1,1",
+    "# comment",
+    "",
+    '" a note',
+    "a = 1 + \\",
+    "  b \\",
+    "include split",
+    "p = (1, 2)",
+]
+
+TRIALS = 300
+EDITS = 10
+
+
+def normalized(g):
+    """g's records and state, with ids replaced by their record's index"""
+    index = {e.id: i for i, e in enumerate(g.explist)}
+    records = []
+    for e in g.explist:
+        d = e.to_dict()
+        d["id"] = index[d["id"]]
+        if "folderId" in d:
+            d["folderId"] = index.get(d["folderId"], d["folderId"])
+        records.append(d)
+    return records, (g.color, g.folder and index[g.folder], g.viewport)
+
+
+class ApplyEditTest(unittest.TestCase):
+    def random_lines(self, rng, n):
+        return [rng.choice(LINES) for _ in range(n)]
+
+    def check_edit(self, rng, g, lines):
+        start = rng.randint(1, len(lines))
+        end = rng.randint(start, min(len(lines), start + 3))
+        new = self.random_lines(rng, rng.randint(0, 3))
+        before = {e.id: e.to_json() for e in g.explist}
+        # as text, "" would be one empty line rather than none
+        text = "\n".join(new) if new and rng.random() < 0.5 else new
+        diff = g.apply_edit(start, end, text)
+        lines[start:end] = new
+        self.assertEqual(g.lines, lines)
+
+        full = dscript.DesmosScript(randseed="0")
+        full.parse("\n".join(lines))
+        self.assertEqual(normalized(g), normalized(full))
+
+        # the diff turns the records before the edit into those after it
+        after = dict(before)
+        for i in diff.removed:
+            del after[i]
+        for e in diff.added + diff.changed:
+            after[e.id] = e.to_json()
+        self.assertEqual(after, {e.id: e.to_json() for e in g.explist})
+        self.assertEqual(len(after), len(g.explist))
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        # warnings of the random lines aren't what is tested
+        with contextlib.redirect_stderr(io.StringIO()):
+            for _ in range(TRIALS):
+                lines = ["y = 0"] + self.random_lines(rng, rng.randint(0, 30))
+                g = dscript.DesmosScript(randseed="0", incremental=True)
+                g.parse("\n".join(lines))
+                for _ in range(EDITS):
+                    self.check_edit(rng, g, lines)
+
+    def test_needs_incremental(self):
+        g = dscript.DesmosScript()
+        g.parse("y = x")
+        with self.assertRaises(ValueError):
+            g.apply_edit(0, 1, "y = 2x")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Adding statements to DesmosScript's parser"""
+import unittest
+
+import dscript
+
+
+class Shout(dscript.PrefixedStatement):
+    PREFIX = "shout"
+
+    @staticmethod
+    def process(graph, l):
+        graph.shouted.append(l)
+        return True
+
+
+class Script(dscript.DesmosScript):
+    STATEMENTS = list(dscript.DesmosScript.STATEMENTS)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shouted = []
+
+
+class StatementsTest(unittest.TestCase):
+    def setUp(self):
+        Script.STATEMENTS = list(dscript.DesmosScript.STATEMENTS)
+
+    def parse(self, source):
+        g = Script(randseed="0")
+        g.parse(source)
+        return g
+
+    def test_modified_in_place(self):
+        # builds the dispatch table before the statement is added
+        self.assertEqual(self.parse("shout hi").shouted, [])
+        Script.STATEMENTS.insert(Script.STATEMENTS.index(dscript.Expression), Shout)
+        self.assertEqual(self.parse("shout hi").shouted, ["shout hi"])
+        Script.STATEMENTS.remove(Shout)
+        self.assertEqual(self.parse("shout hi").shouted, [])
+
+    def test_register_statement(self):
+        self.parse("y = x")
+        Script.register_statement(Shout)
+        g = self.parse("shout hi\ny = x")
+        self.assertEqual(g.shouted, ["shout hi"])
+        self.assertEqual(len(g.explist), 1)
+        # the base class's parser is unchanged
+        self.assertNotIn(Shout, dscript.DesmosScript.STATEMENTS)
+
+
+if __name__ == "__main__":
+    unittest.main()